@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Headless benchmarks for the library scan, clip selection and settings changes.
+
+Builds synthetic libraries of empty video files (reused between runs) and
+drives serendipity_core against a fake mpv player, so no display, GTK or
+libmpv is needed. Each result is printed as one JSON object per line and can
+be appended to a file with --output to track timings across releases.
+
+    python3 benchmarks/bench_library.py --sizes 10000 100000 --output bench.jsonl
+"""
+import gc
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serendipity_core import Settings, ClipLibrary
+
+FILES_PER_SEASON = 50
+SEASONS_PER_SHOW = 10
+
+class FakePlayer:
+    """Just enough of python-mpv's MPV for ClipLibrary.start_clip and load_random_clip.
+
+    `wait_for_property('duration')` sleeps for `duration_latency` seconds to
+    stand in for mpv opening the file and reading its header, and times out
+    if `duration` is None. Item access works as in python-mpv: `player[name]`
+    addresses `options/<name>` and `player.file_local[name]` addresses
+    `file-local-options/<name>`, and a name mpv does not know raises
+    AttributeError.
+    """
+    OPTIONS = ('start', 'end', 'hr-seek')
+
+    def __init__(self, duration_latency=0.0, duration=1800.0):
+        self.duration_latency = duration_latency
+        self.file_duration = duration
+        self.duration = None
+        self.path = None
+        self.time_pos = None
+        self.options = {}
+        self.properties = {}
+        self.commands = []
+        self.file_local = FakeFileLocal(self)
+
+    def loadfile(self, path, mode='replace', **options):
+        for name in options:
+            self._check_option(name.replace('_', '-'))
+        self.path = path
+        self.duration = None
+        self.time_pos = float(options.get('start', 0.0))
+        self.options = dict(options)
+        self.properties = {name: value for name, value in self.properties.items()
+                           if not name.startswith('file-local-options/')}
+
+    def wait_for_property(self, name, timeout=None):
+        if self.duration_latency:
+            time.sleep(self.duration_latency)
+        if self.file_duration is None:
+            # A file that never opens.
+            raise TimeoutError(name)
+        self.duration = self.file_duration
+
+    def command(self, name, *args):
+        self.commands.append((name,) + args)
+
+    def seek(self, position, reference='relative'):
+        self.time_pos = position if reference == 'absolute' else (self.time_pos or 0.0) + position
+
+    def _check_option(self, name):
+        if name not in self.OPTIONS:
+            raise AttributeError(f"mpv property does not exist: {name!r}")
+
+    def __getitem__(self, name, file_local=False):
+        prefix = 'file-local-options/' if file_local else 'options/'
+        self._check_option(name)
+        return self.properties.get(prefix + name)
+
+    def __setitem__(self, name, value, file_local=False):
+        prefix = 'file-local-options/' if file_local else 'options/'
+        self._check_option(name)
+        self.properties[prefix + name] = value
+
+    def playlist_clear(self):
+        pass
+
+    def playlist_next(self, mode='weak'):
+        pass
+
+class FakeFileLocal:
+    """`FakePlayer.file_local`, like python-mpv's proxy of the same name."""
+    def __init__(self, player):
+        self.player = player
+
+    def __getitem__(self, name):
+        return self.player.__getitem__(name, file_local=True)
+
+    def __setitem__(self, name, value):
+        self.player.__setitem__(name, value, file_local=True)
+
+def build_tree(root, count):
+    """Creates `count` empty .mkv files under `root` unless a finished tree is already there."""
+    marker = os.path.join(root, '.complete')
+    if os.path.exists(marker):
+        return
+    print(f"Building synthetic library of {count} files in {root}", file=sys.stderr)
+    per_show = FILES_PER_SEASON * SEASONS_PER_SHOW
+    for n in range(0, count, FILES_PER_SEASON):
+        show, season = divmod(n // FILES_PER_SEASON, SEASONS_PER_SHOW)
+        folder = os.path.join(root, f'Show {show:05d}', f'Season {season:02d}')
+        os.makedirs(folder, exist_ok=True)
+        for episode in range(min(FILES_PER_SEASON, count - n)):
+            open(os.path.join(folder, f'Show {show:05d} S{season:02d}E{episode:02d}.mkv'), 'w').close()
+    # A sprinkling of non-video files the scan has to skip.
+    for show in range(0, max(1, count // per_show)):
+        open(os.path.join(root, f'Show {show:05d}', 'poster.jpg'), 'w').close()
+    open(marker, 'w').close()
+
+class Run:
+    def __init__(self, files, output):
+        self.files = files
+        self.output = output
+        self.stdout = sys.stdout
+
+    def report(self, name, seconds, **extra):
+        result = {
+            'benchmark': name, 'files': self.files, 'seconds': round(seconds, 6),
+            **extra,
+            'python': platform.python_version(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        }
+        line = json.dumps(result)
+        print(line, file=self.stdout)
+        if self.output:
+            with open(self.output, 'a') as f:
+                f.write(line + '\n')
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    value = fn(*args, **kwargs)
+    return value, time.perf_counter() - start
+
+def bench_size(count, args):
+    root = os.path.join(args.workdir, f'library-{count}')
+    build_tree(root, count)
+    run = Run(count, args.output)
+
+    # The library's progress messages go to stderr so stdout stays machine-readable.
+    with tempfile.TemporaryDirectory(prefix='serendipity-bench-') as config_dir, redirect_stdout(sys.stderr):
+        settings = Settings(config_dir)
+        settings.video_library_path = root
+        settings.scan_threads = args.scan_threads
+        library = ClipLibrary(settings)
+
+        # Scanning: an empty index walks everything, a warm one only stats directories.
+        _, seconds = timed(library.scan, on_batch=library.add_blocks)
+        run.report('scan_cold', seconds, found=len(library.library_files))
+        library.reset()
+        _, seconds = timed(library.scan, on_batch=library.add_blocks)
+        run.report('scan_warm', seconds, found=len(library.library_files))
+
+        # Startup from the index alone, and what the in-memory catalogue costs per file.
+        _, seconds = timed(library.restore)
+        library.reset()
+        gc.collect()
+        tracemalloc.start()
+        library.restore()
+        gc.collect()
+        held, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        run.report('restore', seconds, bytes_per_file=round(held / max(1, len(library.library_files)), 1))
+
+        # Selection, as done by play_random_clip before anything is loaded.
+        picks = args.picks
+        _, seconds = timed(lambda: [library.selector.pick() for _ in range(picks)])
+        run.report('select_uniform', seconds, picks=picks, per_pick_us=round(seconds / picks * 1e6, 3))
+
+        # Clip switches: uncached files wait for mpv to report a duration, cached ones do not.
+        player = FakePlayer(duration_latency=args.duration_latency)
+        switches = args.switches
+        _, seconds = timed(lambda: [library.load_random_clip(player) for _ in range(switches)])
+        run.report('switch_uncached', seconds, switches=switches, duration_latency=args.duration_latency,
+                   per_switch_ms=round(seconds / switches * 1000, 3))
+        # Seeded straight into the catalogue; writing a million rows to SQLite is not what is being measured.
+        for file_id in library.video_files.ids:
+            library.catalogue.durations[file_id] = random.uniform(600, 3600)
+        library.metadata.version += 1
+        _, seconds = timed(lambda: [library.load_random_clip(player) for _ in range(switches)])
+        run.report('switch_cached', seconds, switches=switches, per_switch_ms=round(seconds / switches * 1000, 3))
+
+        library.selector.set_weighting(library.clip_weights, lambda: library.metadata.version)
+        _, seconds = timed(lambda: [library.selector.pick() for _ in range(picks)])
+        run.report('select_weighted', seconds, picks=picks, per_pick_us=round(seconds / picks * 1e6, 3))
+        library.selector.set_weighting(None)
+
+        # Settings changes: keyword filters re-filter in memory, new exclusions rescan.
+        settings.keyword_filters = 'S01, S02E1'
+        _, seconds = timed(library.apply_filters)
+        run.report('settings_keywords', seconds, matched=len(library.video_files))
+        settings.keyword_filters = ''
+
+        shows = sorted(entry.name for entry in os.scandir(root) if entry.is_dir())
+        settings.exclusion_folders = [os.path.join(root, name) for name in shows[::4]]
+
+        def rescan():
+            library.reset()
+            return library.scan(on_batch=library.add_blocks)
+        _, seconds = timed(rescan)
+        run.report('settings_exclusions', seconds, excluded_folders=len(settings.exclusion_folders),
+                   found=len(library.library_files))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='library sizes to benchmark (default: 10000 100000 1000000)')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'serendipity-bench'),
+                        help='where synthetic libraries are built and kept between runs')
+    parser.add_argument('--output', help='append results to this JSON-lines file')
+    parser.add_argument('--duration-latency', type=float, default=0.05,
+                        help="seconds the fake player takes to report a file's duration (default: 0.05)")
+    parser.add_argument('--scan-threads', type=int, default=Settings.DEFAULTS['scan_threads'])
+    parser.add_argument('--picks', type=int, default=100000)
+    parser.add_argument('--switches', type=int, default=100)
+    args = parser.parse_args()
+
+    for count in args.sizes:
+        bench_size(count, args)
+
+if __name__ == '__main__':
+    main()
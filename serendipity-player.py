@@ -1,22 +1,33 @@
 import os
+import sys
+import time
+STARTED = time.perf_counter()
+
+if __name__ == "__main__" and sys.argv[1:2] == ['reel']:
+    # Headless: no GTK or mpv needed to write a reel.
+    from serendipity_core import reel_main
+    sys.exit(reel_main(sys.argv[2:]))
+
 os.environ['GDK_BACKEND'] = 'x11'
 
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GLib, Gdk
-import mpv
-import random
-import sys
-import json
+import threading
+
+from serendipity_core import (
+    Settings, ClipLibrary, LibraryWatcher, MediaProber, KeyframeIndexer, ReadAhead, Metrics, SwitchTiming,
+    CommandQueue, clip_options, is_excluded,
+)
 
 class SettingsDialog(Gtk.Dialog):
-    """A dialog to manage the library path, filters, and exclusions."""
-    def __init__(self, parent, current_path, current_filters, current_exclusions):
+    """A dialog to manage the library paths, filters, and exclusions."""
+    def __init__(self, parent, current_path, current_filters, current_exclusions, current_additional_paths=()):
         super().__init__(title="Settings", transient_for=parent, flags=0)
         self.add_buttons(
             Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, Gtk.STOCK_OK, Gtk.ResponseType.OK
         )
-        self.set_default_size(600, 400)
+        self.set_default_size(600, 560)
 
         box = self.get_content_area()
         grid = Gtk.Grid(margin=20, column_spacing=10, row_spacing=15)
@@ -41,35 +52,45 @@ class SettingsDialog(Gtk.Dialog):
         grid.attach(filter_label, 0, 1, 1, 1)
         grid.attach(self.filter_entry, 1, 1, 2, 1)
 
+        # --- Additional Library Folders ---
+        self.additional_store = self._add_folder_list(
+            grid, 2, "Additional Library Folders (other disks or network shares):", current_additional_paths,
+            "Select another library folder")
+
         # --- Exclusion Folders ---
-        exclusion_label = Gtk.Label(label="Exclusion Folders:", xalign=0)
-        grid.attach(exclusion_label, 0, 2, 3, 1)
+        self.exclusion_store = self._add_folder_list(
+            grid, 5, "Exclusion Folders:", current_exclusions, "Select a folder to exclude")
 
-        self.exclusion_store = Gtk.ListStore(str)
-        for folder in current_exclusions:
-            self.exclusion_store.append([folder])
-        
-        treeview = Gtk.TreeView(model=self.exclusion_store)
+        self.show_all()
+
+    def _add_folder_list(self, grid, row, label, folders, chooser_title):
+        """Adds a labelled list of folders with add and remove buttons to `grid`, taking three rows from `row`."""
+        grid.attach(Gtk.Label(label=label, xalign=0), 0, row, 3, 1)
+
+        store = Gtk.ListStore(str)
+        for folder in folders:
+            store.append([folder])
+
+        treeview = Gtk.TreeView(model=store)
         renderer = Gtk.CellRendererText()
         column = Gtk.TreeViewColumn("Folder Path", renderer, text=0)
         treeview.append_column(column)
-        
+
         scrolled_window = Gtk.ScrolledWindow()
         scrolled_window.set_vexpand(True)
         scrolled_window.set_hexpand(True)
         scrolled_window.add(treeview)
-        grid.attach(scrolled_window, 0, 3, 3, 1)
+        grid.attach(scrolled_window, 0, row + 1, 3, 1)
 
         button_box = Gtk.Box(spacing=6)
         add_button = Gtk.Button(label="Add Folder")
-        add_button.connect("clicked", self.on_add_exclusion)
+        add_button.connect("clicked", self.on_add_folder, store, chooser_title)
         remove_button = Gtk.Button(label="Remove Selected")
-        remove_button.connect("clicked", self.on_remove_exclusion, treeview)
+        remove_button.connect("clicked", self.on_remove_folder, treeview)
         button_box.pack_start(add_button, False, False, 0)
         button_box.pack_start(remove_button, False, False, 0)
-        grid.attach(button_box, 0, 4, 3, 1)
-
-        self.show_all()
+        grid.attach(button_box, 0, row + 2, 3, 1)
+        return store
 
     def on_browse_clicked(self, widget):
         dialog = Gtk.FileChooserDialog(
@@ -80,17 +101,17 @@ class SettingsDialog(Gtk.Dialog):
             self.path_entry.set_text(dialog.get_filename())
         dialog.destroy()
 
-    def on_add_exclusion(self, widget):
+    def on_add_folder(self, widget, store, title):
         dialog = Gtk.FileChooserDialog(
-            title="Select a folder to exclude", transient_for=self,
+            title=title, transient_for=self,
             action=Gtk.FileChooserAction.SELECT_FOLDER)
         dialog.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, "Add", Gtk.ResponseType.OK)
         if dialog.run() == Gtk.ResponseType.OK:
             folder = dialog.get_filename()
-            self.exclusion_store.append([folder])
+            store.append([folder])
         dialog.destroy()
 
-    def on_remove_exclusion(self, widget, treeview):
+    def on_remove_folder(self, widget, treeview):
         selection = treeview.get_selection()
         model, treeiter = selection.get_selected()
         if treeiter:
@@ -105,19 +126,46 @@ class SettingsDialog(Gtk.Dialog):
     def get_exclusions(self):
         return [row[0] for row in self.exclusion_store]
 
+    def get_additional_paths(self):
+        return [row[0] for row in self.additional_store]
+
 class MpvPlayerWindow(Gtk.Window):
-    def __init__(self):
+    STATS_OVERLAY_ID = 63
+    STARTUP_TARGET_MS = 2000
+    ROOT_CHECK_INTERVAL = 30
+    # What a clip switch returns when the file did not open in time, as opposed to None for a failed command.
+    OPEN_TIMED_OUT = object()
+
+    def __init__(self, startup_timing=None):
         super().__init__(title="Seredipity Clip Player")
         self.set_default_size(1280, 720)
+        self.connect("destroy", self.on_destroy)
         self.connect("destroy", Gtk.main_quit)
 
         self.is_fullscreen = False
         self.subtitles_auto_enabled = False
         self.is_locked = False
-        self.is_changing_clip = False
-        self.config_dir = os.path.join(GLib.get_user_config_dir(), 'serendipity-player')
-        self.config_file = os.path.join(self.config_dir, 'settings.json')
-        self.load_settings()
+        self.switches_in_flight = 0
+        self.loading_clip = None
+        self.queued_clip = None
+        self.next_candidate = None
+        self.current_filename = ''
+        self.current_clip_length = 0
+        self.settings = Settings(os.path.join(GLib.get_user_config_dir(), 'serendipity-player')).load()
+        # Loaded by _finish_startup once the window is on screen.
+        self.library = None
+        self.prober = None
+        self.keyframe_indexer = None
+        self.read_ahead = ReadAhead()
+        self.startup_timing = startup_timing
+        self.resumed = False
+        self.metrics = Metrics(os.path.join(self.settings.config_dir, 'metrics.jsonl'),
+                               enabled=self.settings.record_metrics)
+        self.switch_timing = None
+        self.last_switch = None
+        self.current_clip = None
+        self.playback_stats = None
+        self.stats_visible = False
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         self.add(vbox)
         self.drawing_area = Gtk.DrawingArea()
@@ -135,6 +183,7 @@ class MpvPlayerWindow(Gtk.Window):
         css = b"""
         box { background-color: rgba(20, 20, 20, 0.85); padding: 5px; }
         button { color: white; background: transparent; border: none; font-size: 24px; }
+        label { color: white; }
         """
         css_provider.load_from_data(css)
         style_context.add_provider(css_provider, Gtk.STYLE_PROVIDER_PRIORITY_USER)
@@ -153,20 +202,26 @@ class MpvPlayerWindow(Gtk.Window):
         self.settings_button = Gtk.Button.new_with_label("⚙")
         self.settings_button.connect("clicked", self.on_open_settings)
         self.control_box.pack_start(self.settings_button, False, False, 5)
+        self.status_label = Gtk.Label()
+        self.status_label.set_no_show_all(True)
+        self.control_box.pack_start(self.status_label, False, False, 5)
         vbox.pack_start(self.control_box, False, True, 0)
         self.connect("key-press-event", self.on_key_press)
         self.player = None
-        self.video_files = self.scan_video_library()
-        self.last_played_file = None
-        if not self.video_files:
-            dialog = Gtk.MessageDialog(
-                transient_for=self, flags=0, message_type=Gtk.MessageType.WARNING,
-                buttons=Gtk.ButtonsType.OK, text=f"No video files found in '{self.video_library_path}'"
-            )
-            dialog.format_secondary_text("Please select a valid directory in the settings (⚙).")
-            dialog.run()
-            dialog.destroy()
+        # Every mpv call goes through here, so a file that is slow to open never blocks the UI.
+        self.control = CommandQueue(post=GLib.idle_add)
+        # mpv playlist entry id -> the path loaded into it, and the entry of the queued clip.
+        # Both are only touched on the player-control thread.
+        self.entry_paths = {}
+        self.queued_entry = None
+        self.scan_generation = 0
+        self.scan_cancel = None
+        self.scans_pending = set()
+        self.root_checks = set()
+        self.library_watchers = {}
+        self.awaiting_first_clip = False
         self.drawing_area.connect("realize", self.on_realize)
+        self.first_draw_handler = self.connect_after("draw", self.on_first_draw)
 
     
     def on_mouse_enter(self, widget, event):
@@ -177,11 +232,15 @@ class MpvPlayerWindow(Gtk.Window):
         """Called when the mouse leaves the video area."""
         if self.player:
             # Clear the OSD by showing an empty message
-            self.player.command('show-text', '', 0)
+            self.control.submit(lambda: self.player.command('show-text', '', 0), key='osd')
 
     def _show_info_osd(self):
-        """Generates and displays the informational OSD."""
-        if not self.player or not self.player.path:
+        if self.player:
+            self.control.submit(self._draw_info_osd, key='osd')
+
+    def _draw_info_osd(self):
+        """Generates and displays the informational OSD. Runs on the player-control thread."""
+        if not self.player.path:
             return
 
         osd_line1 = self.current_filename
@@ -204,177 +263,488 @@ class MpvPlayerWindow(Gtk.Window):
             return True # Return True to indicate the event was handled
         return False
 
-    def load_settings(self):
-        # Default values
-        self.video_library_path = os.path.expanduser('~/Videos')
-        self.min_clip_duration = 30
-        self.max_clip_duration = 90
-        self.supported_extensions = ['.mp4', '.mkv', '.avi', '.mov', '.webm', '.flv']
-        self.keyword_filters = ''
-        self.exclusion_folders = []
-
-        if os.path.exists(self.config_file):
-            try:
-                with open(self.config_file, 'r') as f:
-                    config = json.load(f)
-                self.video_library_path = config.get('video_library_path', self.video_library_path)
-                self.min_clip_duration = config.get('min_clip_duration', self.min_clip_duration)
-                self.max_clip_duration = config.get('max_clip_duration', self.max_clip_duration)
-                self.supported_extensions = config.get('supported_extensions', self.supported_extensions)
-                self.keyword_filters = config.get('keyword_filters', self.keyword_filters)
-                self.exclusion_folders = config.get('exclusion_folders', self.exclusion_folders)
-            except (json.JSONDecodeError, IOError):
-                print(f"Warning: Could not read settings file at {self.config_file}. Using defaults.")
-        else:
-            self.save_settings()
-
-    def save_settings(self):
-        os.makedirs(self.config_dir, exist_ok=True)
-        config = {
-            'video_library_path': self.video_library_path,
-            'min_clip_duration': self.min_clip_duration,
-            'max_clip_duration': self.max_clip_duration,
-            'supported_extensions': self.supported_extensions,
-            'keyword_filters': self.keyword_filters,
-            'exclusion_folders': self.exclusion_folders
-        }
-        with open(self.config_file, 'w') as f:
-            json.dump(config, f, indent=4)
-
     def on_open_settings(self, widget):
-        dialog = SettingsDialog(self, self.video_library_path, self.keyword_filters, self.exclusion_folders)
+        if self.library is None:
+            return
+        settings = self.settings
+        dialog = SettingsDialog(self, settings.video_library_path, settings.keyword_filters, settings.exclusion_folders,
+                                settings.additional_library_paths)
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
             new_path = dialog.get_path()
             new_filters = dialog.get_filters()
             new_exclusions = dialog.get_exclusions()
+            new_additional_paths = dialog.get_additional_paths()
 
             # Check if anything has changed
-            path_changed = new_path != self.video_library_path and os.path.isdir(new_path)
-            filters_changed = new_filters != self.keyword_filters
-            exclusions_changed = set(new_exclusions) != set(self.exclusion_folders)
+            path_changed = new_path != settings.video_library_path and os.path.isdir(new_path)
+            if not path_changed:
+                new_path = settings.video_library_path
+            roots_changed = path_changed or new_additional_paths != settings.additional_library_paths
+            filters_changed = new_filters != settings.keyword_filters
+            exclusions_changed = set(new_exclusions) != set(settings.exclusion_folders)
 
-            if path_changed or filters_changed or exclusions_changed:
-                print("Settings changed, re-scanning library.")
-                self.video_library_path = new_path
-                self.keyword_filters = new_filters
-                self.exclusion_folders = new_exclusions
-                self.save_settings()
+            if roots_changed or filters_changed or exclusions_changed:
+                # Only changed roots or a folder that is no longer excluded need the disk;
+                # everything else is a re-filter of the files already in memory.
+                # Roots that did not change keep their index shards, so their rescan is incremental.
+                needs_rescan = roots_changed or not set(new_exclusions) >= set(settings.exclusion_folders)
+                settings.video_library_path = new_path
+                settings.additional_library_paths = new_additional_paths
+                settings.keyword_filters = new_filters
+                settings.exclusion_folders = new_exclusions
+                settings.save()
 
                 if self.player:
-                    self.player.stop()
-                self.video_files = self.scan_video_library()
-                
-                if self.video_files and self.player:
-                    self.play_random_clip()
-                elif not self.video_files:
-                     dialog = Gtk.MessageDialog(
-                        transient_for=self, flags=0, message_type=Gtk.MessageType.ERROR,
-                        buttons=Gtk.ButtonsType.OK, text=f"No video files found with current settings in '{self.video_library_path}'"
-                    )
-                     dialog.run()
-                     dialog.destroy()
+                    self.control.submit(self.player.stop)
+                self._clear_queued_clip()
+                if needs_rescan:
+                    print("Settings changed, re-scanning library.")
+                    self.start_library_scan()
+                else:
+                    print("Filters changed, re-filtering library.")
+                    self.library.apply_filters()
+                    if self.scan_cancel is None:
+                        self.prober.set_backlog(self.library.unprobed())
+                        if self.keyframe_indexer is not None:
+                            self.keyframe_indexer.set_backlog(self.library.video_files)
+                    if self.library.video_files:
+                        self.play_random_clip(trigger='settings')
+                    elif self.scan_cancel is None:
+                        self._warn_no_videos()
         dialog.destroy()
 
+    def on_destroy(self, widget):
+        # Remember where we were, so the next start can pick up from here.
+        if self.player and self.current_clip is not None:
+            position = self.player.time_pos
+            if position is not None:
+                self.library.save_last_clip(self.current_clip, position)
+        self.control.stop()
+
     def on_end_file(self, event):
         """Callback for when a file finishes playing."""
         print(f"DEBUG: end-file event received. Reason: '{str(event.data.reason)}'")
         
+        # The entry is looked up on the control thread, behind the loadfile that created it.
+        entry_id = getattr(event.data, 'playlist_entry_id', None)
         if str(event.data.reason) == '0':
-            GLib.idle_add(self._handle_end_of_file)
+            ended = time.perf_counter()
+            self.control.submit(lambda: self.entry_paths.get(entry_id),
+                                lambda path: self._handle_end_of_file(ended, path))
+        elif str(event.data.reason) == '4':
+            self.control.submit(lambda: self.entry_paths.get(entry_id), self._on_playback_error)
 
-    def _handle_end_of_file(self):
-        if self.is_changing_clip: return GLib.SOURCE_REMOVE
+    def _handle_end_of_file(self, ended, path):
+        if path is not None:
+            # Played to the end, so a file on probation has earned its way out of quarantine.
+            self.library.quarantine.release(path)
+        if self.switches_in_flight:
+            # The file that ended is being replaced already.
+            return GLib.SOURCE_REMOVE
+        if self.queued_clip is not None:
+            # mpv continues with the queued clip on its own; _on_file_loaded takes over.
+            self.switch_timing = SwitchTiming('end', started=ended)
+            self.switch_timing.source = 'queued'
+            return GLib.SOURCE_REMOVE
         if self.is_locked:
             print("Locked video finished. Unlocking and playing next clip.")
             self.is_locked = False
             self.lock_button.set_label("🔓")
         else:
             print("File finished. Playing next clip.")
-        self.play_random_clip()
+        self.play_random_clip(trigger='end', started=ended)
         return GLib.SOURCE_REMOVE
 
+    def _on_playback_error(self, path):
+        """mpv gave up on `path`: quarantine it and make sure something is still playing."""
+        if not path:
+            # Not a file we loaded, or one loaded so long ago that it has been forgotten.
+            return GLib.SOURCE_REMOVE
+        print(f"Warning: mpv could not play '{os.path.basename(path)}'.", file=sys.stderr)
+        self.library.quarantine_file(path, "playback error")
+        if self.next_candidate is not None and self.library.catalogue.path(self.next_candidate) == path:
+            self.next_candidate = None
+        if self.loading_clip is not None and self.loading_clip.path == path:
+            self.loading_clip = None
+        if self.queued_clip is not None and self.queued_clip.path == path:
+            self._clear_queued_clip()
+        # Unless mpv is already moving on to another clip, it is now idle.
+        if self.loading_clip is None and self.queued_clip is None and not self.switches_in_flight:
+            self.play_random_clip(trigger='error')
+        return GLib.SOURCE_REMOVE
+
+    def _retry_quarantined(self):
+        """Hands quarantined files whose retry is due back to the prober; they return to the selection if it succeeds."""
+        for path in self.library.quarantine.due():
+            self.prober.request(path)
+        return GLib.SOURCE_CONTINUE
+
     def on_realize(self, widget):
+        gdk_window = self.drawing_area.get_window()
+        display = self.drawing_area.get_display()
+        gdk_window.set_cursor(Gdk.Cursor.new_for_display(display, Gdk.CursorType.ARROW))
+
+    def on_first_draw(self, widget, cr):
+        self.disconnect(self.first_draw_handler)
+        if self.startup_timing is not None:
+            self.startup_timing.mark('first_paint')
+        # Let the frame reach the screen before doing the slow part of startup.
+        GLib.idle_add(self._finish_startup)
+        return False
+
+    def _finish_startup(self):
+        """Loads the library and starts mpv, after the window has been painted.
+
+        The library and its caches are loaded in a background thread while
+        mpv starts here, so the painted window never freezes. The library is
+        restored from the index left by the last run, so the first clip can
+        start before the disk has been walked; a refresh scan then catches up
+        with changes in the background.
+        """
+        threading.Thread(target=self._load_library, daemon=True).start()
+        self._init_player()
+        if self.startup_timing is not None:
+            self.startup_timing.mark('mpv')
+        return GLib.SOURCE_REMOVE
+
+    def _load_library(self):
+        library = ClipLibrary(self.settings)
+        restored = library.restore()
+        last_clip = library.last_clip() if restored and self.settings.resume_last_clip else None
+        if last_clip is not None and not os.path.exists(last_clip.path):
+            # Checked here, as a file on a hung share would block the GTK thread.
+            last_clip = None
+        GLib.idle_add(self._on_library_loaded, library, restored, last_clip)
+
+    def _on_library_loaded(self, library, restored, last_clip):
+        timing = self.startup_timing
+        if timing is not None:
+            # Whatever is left of loading the library once mpv is up.
+            timing.mark('library')
+        settings = self.settings
+        self.library = library
+        self.prober = MediaProber(self.library.metadata, workers=settings.probe_workers, on_probed=self.on_probed,
+                                  quarantine=self.library.quarantine)
+        GLib.timeout_add_seconds(60, self._retry_quarantined)
+        GLib.timeout_add_seconds(self.ROOT_CHECK_INTERVAL, self._check_roots)
+        if settings.snap_to_keyframes:
+            if KeyframeIndexer.available():
+                self.keyframe_indexer = KeyframeIndexer(self.library.keyframes, workers=settings.keyframe_workers)
+            else:
+                print("Warning: ffprobe not found, clip starts will not be snapped to keyframes.", file=sys.stderr)
+        if not self.player:
+            return GLib.SOURCE_REMOVE
+        if restored:
+            self.awaiting_first_clip = True
+            if last_clip is not None:
+                self._resume_clip(last_clip)
+            else:
+                self._play_first_clip()
+            self.start_library_scan(refresh=True)
+        else:
+            self.start_library_scan()
+        return GLib.SOURCE_REMOVE
+
+    def _init_player(self):
+        # Imported here, as loading libmpv is one of the slower parts of startup.
+        import mpv
+
         def mpv_log(level, prefix, text):
             print(f'[mpv {level}] {prefix}: {text.strip()}', file=sys.stderr)
         if self.player: return
         try:
-            gdk_window = self.drawing_area.get_window()
-            display = self.drawing_area.get_display()
-            gdk_window.set_cursor(Gdk.Cursor.new_for_display(display, Gdk.CursorType.ARROW))
-
-            wid = str(gdk_window.get_xid())
+            wid = str(self.drawing_area.get_window().get_xid())
             self.player = mpv.MPV(
                 wid=wid, vo='x11', log_handler=mpv_log,
                 input_default_bindings=True, input_vo_keyboard=True,
-                input_cursor=False, af='loudnorm'
+                input_cursor=False, af='loudnorm', prefetch_playlist=True
             )
-            self.player.observe_property('time-pos', self.on_time_pos_change)
+            # Events reach the UI through the command queue, after the commands that caused them.
+            @self.player.event_callback('file-loaded')
+            def file_loaded_handler(event):
+                self.control.after(self._on_file_loaded, self.player.path)
             @self.player.event_callback('end-file')
             def end_file_handler(event):
                 self.on_end_file(event)
+            @self.player.event_callback('playback-restart')
+            def playback_restart_handler(event):
+                self.control.submit(lambda: self.player.time_pos, self._on_playback_restart)
+            GLib.timeout_add_seconds(1, self._sample_playback)
             print("mpv player initialized and embedded.")
-            if self.video_files:
-                GLib.idle_add(self.play_random_clip)
         except Exception as e:
             print(f"Fatal Error initializing mpv: {e}", file=sys.stderr)
             Gtk.main_quit()
 
-    def scan_video_library(self):
-        files = []
-        if not os.path.isdir(self.video_library_path):
-            print(f"Error: Library path '{self.video_library_path}' does not exist.", file=sys.stderr)
-            return files
-            
-        print(f"Scanning for videos in: {self.video_library_path}")
-        filters = [f.strip().lower() for f in self.keyword_filters.split(',') if f.strip()]
-        
-        for root, _, filenames in os.walk(self.video_library_path):
-           
-            if any(root.startswith(excluded_folder) for excluded_folder in self.exclusion_folders):
-                continue
-
-            for filename in filenames:
-               
-                if any(filename.lower().endswith(ext) for ext in self.supported_extensions):
-                    full_path = os.path.join(root, filename)
-                    
-                    if filters:
-                        path_lower = full_path.lower()
-                        if not any(f in path_lower for f in filters):
-                            continue # Skip file if no filter keyword matches
-                    
-                    files.append(full_path)
-
-        print(f"Found {len(files)} video files matching criteria.")
-        return files
+    def start_library_scan(self, refresh=False):
+        """Rescans every library root, each in its own background thread, streaming files into the library's lists.
+
+        With `refresh`, the files already in the library stay and only the
+        differences found on disk are applied as each root completes.
+        """
+        if self.scan_cancel is not None:
+            self.scan_cancel.set()
+        for watcher in self.library_watchers.values():
+            watcher.stop()
+        self.library_watchers = {}
+        self.scan_generation += 1
+        self.scan_cancel = None
+        self.scans_pending = set()
+        if not refresh:
+            self.library.reset()
+            self.next_candidate = None
+            self.awaiting_first_clip = True
+            self.status_label.set_text("Scanning… 0 videos")
+            self.status_label.show()
+        for root in self.library.roots:
+            self._start_root_scan(root, refresh)
+        if not self.scans_pending:
+            self._on_scan_finished()
+
+    def _start_root_scan(self, root, refresh):
+        """Scans one root in a thread of its own, so that a slow or hung share holds up no other root."""
+        if self.scan_cancel is None:
+            self.scan_cancel = threading.Event()
+        self.scans_pending.add(root)
+        threading.Thread(
+            target=self._scan_worker, args=(self.scan_generation, self.scan_cancel, refresh, root), daemon=True
+        ).start()
+
+    def _scan_worker(self, generation, cancel, refresh, root):
+        def post_batch(batch):
+            GLib.idle_add(self._on_scan_batch, generation, root, batch)
+
+        def post_changes(added, removed):
+            GLib.idle_add(self._on_library_changed, generation, added, removed, [])
+        cached = []
+        try:
+            if refresh:
+                files = self.library.scan_root(root, cancel=cancel, on_changes=post_changes)
+            else:
+                files = self.library.scan_root(root, on_batch=post_batch, cancel=cancel)
+                if files is None:
+                    # The library was emptied for this scan, so an offline root's files come from
+                    # its index shard; they stay out of the selection, ready for when it returns.
+                    cached = self.library.cached_blocks(root)
+        except Exception as e:
+            print(f"Error scanning library folder '{root}': {e}", file=sys.stderr)
+            files = []
+        if not cancel.is_set():
+            GLib.idle_add(self._on_root_scanned, generation, root, files is not None, cached)
+
+    def _on_scan_batch(self, generation, root, batch):
+        if generation != self.scan_generation or root not in self.scans_pending:
+            return GLib.SOURCE_REMOVE
+        self.library.add_blocks(batch)
+        self.status_label.set_text(f"Scanning… {len(self.library.video_files)} videos")
+        self._play_first_clip()
+        return GLib.SOURCE_REMOVE
+
+    def _play_first_clip(self):
+        """Starts playback once both the player and the first scanned files are ready."""
+        if self.awaiting_first_clip and self.player and self.library.video_files:
+            self.play_random_clip(trigger='start')
+        return GLib.SOURCE_REMOVE
+
+    def _on_root_scanned(self, generation, root, online, cached):
+        if generation != self.scan_generation or root not in self.scans_pending:
+            # A newer scan, or a scan that was given up on, see _abandon_root_scan.
+            return GLib.SOURCE_REMOVE
+        self.scans_pending.discard(root)
+        roots_changed = self.library.set_root_online(root, online)
+        self.library.add_blocks(cached)
+        if roots_changed:
+            self._on_roots_changed()
+        if online:
+            self._watch_root(generation, root)
+            if self.scans_pending:
+                # Background work on this root need not wait for the others.
+                files = self.library.root_files(root)
+                self.prober.extend_backlog(self.library.unprobed(files))
+                if self.keyframe_indexer is not None:
+                    self.keyframe_indexer.extend_backlog(files)
+        if not self.scans_pending:
+            self._on_scan_finished()
+        return GLib.SOURCE_REMOVE
+
+    def _abandon_root_scan(self, root):
+        """Stops waiting for the scan of `root`, which went offline or hung, and falls back on its index shard.
+
+        Whatever the scan has delivered so far is replaced by the folders as
+        the last complete scan left them, and anything it delivers later is
+        ignored. The root is picked up again when a check finds it back.
+        """
+        print(f"Warning: Gave up on scanning '{root}'; using its files as last indexed.", file=sys.stderr)
+        self.scans_pending.discard(root)
+        generation = self.scan_generation
+
+        def load_cached():
+            try:
+                cached = self.library.cached_blocks(root)
+            except Exception as e:
+                print(f"Error reading the index of library folder '{root}': {e}", file=sys.stderr)
+                cached = []
+            GLib.idle_add(self._on_scan_abandoned, generation, root, cached)
+        threading.Thread(target=load_cached, daemon=True).start()
+        if self.library.set_root_online(root, False):
+            self._on_roots_changed()
+        if not self.scans_pending:
+            self._on_scan_finished()
+
+    def _on_scan_abandoned(self, generation, root, cached):
+        if generation != self.scan_generation:
+            return GLib.SOURCE_REMOVE
+        self.library.remove_files([], [root])
+        self.library.add_blocks(cached)
+        return GLib.SOURCE_REMOVE
+
+    def _on_scan_finished(self):
+        self.scan_cancel = None
+        self.status_label.hide()
+        self.metrics.record('scan', videos=len(self.library.video_files), roots=len(self.library.roots),
+                            offline_roots=len(self.library.offline), **self.library.last_scan)
+        self.prober.set_backlog(self.library.unprobed())
+        if self.keyframe_indexer is not None:
+            self.keyframe_indexer.set_backlog(self.library.video_files)
+        if not self.library.video_files:
+            self._warn_no_videos()
+
+    def _watch_root(self, generation, root):
+        settings = self.settings
+        if not settings.watch_library or root in self.library_watchers:
+            return
+        watcher = LibraryWatcher(
+            self.library.index_for(root), root, settings.supported_extensions, settings.exclusion_folders,
+            on_change=lambda *changes: GLib.idle_add(self._on_library_changed, generation, *changes),
+            scan_threads=settings.scan_threads)
+        self.library_watchers[root] = watcher
+        watcher.start()
+
+    def _check_roots(self):
+        """Looks for library roots that went offline or came back.
+
+        Each root is checked from a thread of its own, including roots that
+        are still being scanned. A root whose last check has not returned by
+        the next one is a hung network share, and is treated as offline until
+        that check comes back.
+        """
+        for root in self.library.roots:
+            if root in self.root_checks:
+                self._on_root_state(root, False)
+            else:
+                self.root_checks.add(root)
+                threading.Thread(target=self._root_check_worker, args=(self.scan_generation, root),
+                                 daemon=True).start()
+        return GLib.SOURCE_CONTINUE
+
+    def _root_check_worker(self, generation, root):
+        GLib.idle_add(self._on_root_checked, generation, root, os.path.isdir(root))
+
+    def _on_root_checked(self, generation, root, online):
+        self.root_checks.discard(root)
+        if generation == self.scan_generation:
+            self._on_root_state(root, online)
+        return GLib.SOURCE_REMOVE
+
+    def _on_root_state(self, root, online):
+        """Acts on a check finding `root` online or offline."""
+        if root in self.scans_pending:
+            # A scan that is still running reports on the root itself, unless the root has gone.
+            if not online:
+                self._abandon_root_scan(root)
+            return
+        if not self.library.set_root_online(root, online):
+            return
+        if online:
+            # Its files are selectable again straight away; this root alone is then checked for changes.
+            self._start_root_scan(root, refresh=True)
+        else:
+            watcher = self.library_watchers.pop(root, None)
+            if watcher is not None:
+                watcher.stop()
+        self._on_roots_changed()
+
+    def _on_roots_changed(self):
+        """Brings the queued clip and the background work in line with the roots that are online."""
+        if self.queued_clip is not None and is_excluded(self.queued_clip.path, self.library.offline):
+            self._clear_queued_clip()
+            self._queue_next_clip()
+        if self.scan_cancel is None:
+            self.prober.set_backlog(self.library.unprobed())
+            if self.keyframe_indexer is not None:
+                self.keyframe_indexer.set_backlog(self.library.video_files)
+        self._play_first_clip()
+
+    def _on_library_changed(self, generation, added, removed, removed_dirs):
+        """Applies files added or removed on disk while the player is running."""
+        if generation != self.scan_generation:
+            return GLib.SOURCE_REMOVE
+        if removed or removed_dirs:
+            still_present = self.library.remove_files(removed, removed_dirs)
+            if self.queued_clip is not None and not still_present(self.queued_clip.path):
+                self._clear_queued_clip()
+                self._queue_next_clip()
+        if added:
+            for path in added:
+                # A file that was written again gets another chance.
+                self.library.quarantine.release(path)
+            new_videos = self.library.add_files(added)
+            self.prober.extend_backlog(new_videos)
+            if self.keyframe_indexer is not None:
+                self.keyframe_indexer.extend_backlog(new_videos)
+        print(f"Library changed on disk: {len(added)} added, {len(removed)} removed, "
+              f"{len(removed_dirs)} folders removed.")
+        self._play_first_clip()
+        return GLib.SOURCE_REMOVE
+
+    def _warn_no_videos(self):
+        roots = "', '".join(self.library.roots)
+        dialog = Gtk.MessageDialog(
+            transient_for=self, flags=0, message_type=Gtk.MessageType.WARNING,
+            buttons=Gtk.ButtonsType.OK, text=f"No video files found with current settings in '{roots}'"
+        )
+        dialog.format_secondary_text("Please select a valid directory in the settings (⚙).")
+        dialog.run()
+        dialog.destroy()
 
     def on_next_clicked(self, widget):
-        if self.is_changing_clip: return
         if self.is_locked:
             self.is_locked = False
             self.lock_button.set_label("🔓")
-            self.player.command('show-text', 'Video Unlocked', 2000)
+            self._show_text('Video Unlocked', 2000)
         self.play_random_clip()
     
     def on_toggle_lock(self, widget):
-        if not self.player or not self.player.path:
+        if not self.player or self.current_clip is None:
             return
         self.is_locked = not self.is_locked
         self.lock_button.set_label("🔒" if self.is_locked else "🔓")
         if self.is_locked:
-            self.player.command('show-text', 'Video Locked', 2000)
+            def lift_end():
+                # Lift mpv's end bound for this file only; the queued clip keeps its own.
+                self.player.file_local['end'] = 'none'
+            self.control.submit(lift_end)
+            self._show_text('Video Locked', 2000)
             print("Video locked. Will play to end.")
         else:
-            if self.is_changing_clip: return
-            self.player.command('show-text', 'Video Unlocked', 2000)
+            self._show_text('Video Unlocked', 2000)
             print("Video unlocked. Playing new random clip.")
             self.play_random_clip()
 
+    def _show_text(self, text, duration_ms):
+        self.control.submit(lambda: self.player.command('show-text', text, duration_ms), key='osd')
+
     def on_toggle_pause(self, widget):
         if self.player:
-            self.player.pause = not self.player.pause
-            self.play_pause_button.set_label("▶" if self.player.pause else "⏸")
+            self.control.submit(self._toggle_pause, self._on_pause_toggled)
+
+    def _toggle_pause(self):
+        self.player.pause = not self.player.pause
+        return self.player.pause
+
+    def _on_pause_toggled(self, paused):
+        if paused is not None:
+            self.play_pause_button.set_label("▶" if paused else "⏸")
 
     def on_toggle_fullscreen(self, widget):
         if self.is_fullscreen:
@@ -402,116 +772,361 @@ class MpvPlayerWindow(Gtk.Window):
         elif keyval == Gdk.KEY_n:
             self.on_next_clicked(None)
             return True
+        elif keyval == Gdk.KEY_i:
+            self.on_toggle_stats()
+            return True
         elif keyval == Gdk.KEY_m:
-            if not self.player: return True
-            self.player.mute = not self.player.mute
-            print(f"Mute: {self.player.mute}")
-            if self.player.mute:
-                if not self.player.sid and self.player.track_list:
-                    sub_tracks = [t for t in self.player.track_list if t.get('type') == 'sub']
-                    if sub_tracks:
-                        self.player.sid = sub_tracks[0]['id']
-                        self.subtitles_auto_enabled = True
-                        print("Muted. Auto-enabled subtitles.")
-            else:
-                if self.subtitles_auto_enabled:
-                    self.player.sid = 0
-                    self.subtitles_auto_enabled = False
-                    print("Unmuted. Auto-disabled subtitles.")
+            if self.player:
+                self.control.submit(self._toggle_mute)
             return True
         elif keyval == Gdk.KEY_s:
-            if not self.player: return True
-            if self.player.sid:
-                self.player.sid = 0
-                self.subtitles_auto_enabled = False
-                print("Subtitles manually disabled.")
-            else:
-                if self.player.track_list:
-                    sub_tracks = [t for t in self.player.track_list if t.get('type') == 'sub']
-                    if sub_tracks:
-                        self.player.sid = sub_tracks[0]['id']
-                        self.subtitles_auto_enabled = False
-                        print("Subtitles manually enabled.")
-                    else:
-                        print("No subtitle tracks found.")
+            if self.player:
+                self.control.submit(self._toggle_subtitles)
             return True
         return False
 
-    def play_random_clip(self):
-        if self.is_changing_clip: return
-        self.is_changing_clip = True
-        try:
-            if not self.video_files or self.player is None:
-                return
-            available_files = [f for f in self.video_files if f != self.last_played_file]
-            if not available_files:
-                available_files = self.video_files
-            chosen_file = random.choice(available_files)
-            self.last_played_file = chosen_file
+    # _toggle_mute and _toggle_subtitles run on the player-control thread, as does
+    # every other use of subtitles_auto_enabled.
+    def _toggle_mute(self):
+        self.player.mute = not self.player.mute
+        print(f"Mute: {self.player.mute}")
+        if self.player.mute:
+            if not self.player.sid and self.player.track_list:
+                sub_tracks = [t for t in self.player.track_list if t.get('type') == 'sub']
+                if sub_tracks:
+                    self.player.sid = sub_tracks[0]['id']
+                    self.subtitles_auto_enabled = True
+                    print("Muted. Auto-enabled subtitles.")
+        else:
+            if self.subtitles_auto_enabled:
+                self.player.sid = 0
+                self.subtitles_auto_enabled = False
+                print("Unmuted. Auto-disabled subtitles.")
+
+    def _toggle_subtitles(self):
+        if self.player.sid:
+            self.player.sid = 0
             self.subtitles_auto_enabled = False
-            self.player.loadfile(chosen_file, 'replace')
-            self.player.wait_for_property('duration')
-            duration = self.player.duration
-            if duration is None or duration <= self.min_clip_duration:
-                start_pos = 0
-                self.end_pos = duration + 1 if duration else 99999
-                print(f"Video is short, playing entire file.")
-            else:
-                actual_max_clip = min(self.max_clip_duration, duration)
-                clip_duration = random.uniform(self.min_clip_duration, actual_max_clip)
+            print("Subtitles manually disabled.")
+        else:
+            if self.player.track_list:
+                sub_tracks = [t for t in self.player.track_list if t.get('type') == 'sub']
+                if sub_tracks:
+                    self.player.sid = sub_tracks[0]['id']
+                    self.subtitles_auto_enabled = False
+                    print("Subtitles manually enabled.")
+                else:
+                    print("No subtitle tracks found.")
 
-                min_start_boundary = duration * 0.10
-                max_start_boundary = (duration * 0.90) - clip_duration
+    def play_random_clip(self, trigger='skip', started=None):
+        """Switches to a new random clip. The file is chosen here; mpv is driven from the control thread.
 
-                if min_start_boundary < max_start_boundary:
-                    start_pos = random.uniform(min_start_boundary, max_start_boundary)
-                    print("Choosing clip from the middle 80% of the video.")
+        A switch asked for while another one is still waiting to run is
+        merged into it, so mashing `n` skips once. One asked for while a
+        switch is already loading is queued behind it instead of dropped.
+        """
+        if (self.player is None or self.library is None or not self.library.video_files
+                or self.control.pending('switch')):
+            return GLib.SOURCE_REMOVE
+        self.awaiting_first_clip = False
+        timing = SwitchTiming(trigger, started)
+        player = self.player
+        if self.queued_clip is not None:
+            # The next clip is already in mpv's playlist and being prefetched.
+            clip, self.queued_clip = self.queued_clip, None
+            path = clip.path
+            timing.mark('selection')
+            timing.source = 'queued'
+        else:
+            path, clip = self.library.pick_clip(timing)
+            if clip is None:
+                self.prober.request(path)
+            timing.source = 'cached' if clip is not None else 'uncached'
+
+        def switch():
+            timing.mark('control_wait')
+            self.subtitles_auto_enabled = False
+            if timing.source != 'queued':
+                clip_started = self.library.start_clip(player, path, clip, timing, on_load=self._note_entry)
+                if clip_started is None:
+                    return self.OPEN_TIMED_OUT
+            else:
+                # Compared by entry rather than path, which the queued clip may share with the current one.
+                current = next((entry.get('id') for entry in player.playlist or [] if entry.get('current')), None)
+                if self.queued_entry is not None and current == self.queued_entry:
+                    # mpv got there by itself in the meantime, so its file-loaded found nothing to match.
+                    self.control.after(self._on_file_loaded, path)
                 else:
-                    max_start_pos = duration - clip_duration
-                    start_pos = random.uniform(0, max_start_pos)
-                    print("Warning: Clip too long for 'safe zone'. Choosing from entire video.")
-                
-                self.end_pos = start_pos + clip_duration
-
-            self.player.seek(start_pos, 'absolute')
-            self.player.pause = False
-            self.play_pause_button.set_label("⏸")
-            filename = os.path.basename(chosen_file)
-            
-         
-            m, s = divmod(start_pos, 60)
-            h, m = divmod(m, 60)
-            formatted_start_time = f"{int(h):02d}:{int(m):02d}:{int(s):02d}"
-
-            clip_len_seconds = int(self.end_pos - start_pos)
-            
-            osd_message = (
-                f"{filename}\n"
-                f"Timestamp: {formatted_start_time} | Duration: {clip_len_seconds}s"
-            )
-            self.player.command('show-text', osd_message, 4000)
-            
-            self.set_title(f"Serendipity Clip Player - {filename}")
-            print(f"Playing '{filename}'. Start: {start_pos:.2f}s, End: {self.end_pos:.2f}s")
-        finally:
-            self.is_changing_clip = False
+                    player.playlist_next('force')
+                self.queued_entry = None
+                timing.mark('loadfile')
+                clip_started = clip
+            player.pause = False
+            return clip_started
+        self.switches_in_flight += 1
+        self.control.submit(switch, lambda result: self._on_switched(path, result, timing), key='switch')
         return GLib.SOURCE_REMOVE
-    
-    def on_time_pos_change(self, name, value):
-        GLib.idle_add(self._check_clip_end, value)
 
-    def _check_clip_end(self, current_pos):
-        if self.is_locked or self.is_changing_clip:
+    def _on_switched(self, path, result, timing):
+        self.switches_in_flight -= 1
+        if result is None:
+            # An mpv command failed, which says nothing about the file; the control thread has logged it.
+            return
+        if result is self.OPEN_TIMED_OUT:
+            # The file did not open in time; quarantine it and try another one shortly.
+            self.library.quarantine_file(path, f"not opened within {self.settings.open_timeout}s")
+            GLib.timeout_add_seconds(1, self.play_random_clip, timing.trigger, timing.started)
+            return
+        self.loading_clip = result
+        self.switch_timing = timing
+        self._watch_load(result)
+        self.play_pause_button.set_label("⏸")
+
+    def _watch_load(self, clip):
+        """Gives mpv `open_timeout` seconds from now to report `clip` loaded, whether it was cached, queued or not."""
+        GLib.timeout_add_seconds(self.settings.open_timeout, self._on_load_timeout, clip)
+
+    def _on_load_timeout(self, clip):
+        """No file-loaded for `clip` yet: quarantine its file and move on, unless another switch has taken over."""
+        if self.loading_clip is not clip:
+            return GLib.SOURCE_REMOVE
+        print(f"Warning: mpv did not load '{os.path.basename(clip.path)}' within {self.settings.open_timeout}s.",
+              file=sys.stderr)
+        self.loading_clip = None
+        self.library.quarantine_file(clip.path, f"not loaded within {self.settings.open_timeout}s")
+        if not self.switches_in_flight:
+            self.play_random_clip(trigger='timeout')
+        return GLib.SOURCE_REMOVE
+
+    def _resume_clip(self, clip):
+        """Starts the clip that was playing when the player was closed, from where it was left."""
+        print(f"Resuming '{os.path.basename(clip.path)}' at {clip.start_pos:.2f}s.")
+        self.awaiting_first_clip = False
+        self.resumed = True
+        timing = SwitchTiming('start')
+        timing.source = 'resumed'
+        self.loading_clip = clip
+        self.switch_timing = timing
+        self._watch_load(clip)
+
+        def load():
+            self.player.loadfile(clip.path, 'replace', **clip_options(clip))
+            self._note_entry(clip.path)
+            timing.mark('loadfile')
+        self.control.submit(load)
+
+    def _queue_next_clip(self):
+        """Appends the next clip to mpv's playlist so that it is prefetched before it is needed."""
+        if self.queued_clip is not None or self.player is None or not self.library.video_files:
+            return
+        if self.next_candidate is None:
+            self.next_candidate = self.library.selector.pick()
+        clip = self.library.plan_clip(self.next_candidate)
+        if clip is None:
+            # Queued once the prober has read its duration, see _on_probed.
+            self.prober.request(self.library.catalogue.path(self.next_candidate), self.next_candidate)
+            return
+        self.next_candidate = None
+
+        def append():
+            self.player.playlist_clear()
+            self.player.loadfile(clip.path, 'append', **clip_options(clip))
+            self.queued_entry = self._note_entry(clip.path)
+        self.control.submit(append)
+        self.queued_clip = clip
+        ranges = self.library.read_ahead_ranges(clip, self.settings.read_ahead_bytes)
+        if ranges:
+            self.read_ahead.prefetch(clip.path, ranges)
+        print(f"Queued next clip '{os.path.basename(clip.path)}'.")
+
+    def _note_entry(self, path):
+        """Remembers the playlist entry `path` was just loaded into. Runs on the player-control thread.
+
+        end-file events only name the entry, and mpv may have moved on to
+        another file by the time they arrive, so they are traced back here.
+        """
+        playlist = self.player.playlist or []
+        entry_id = playlist[-1].get('id') if playlist else None
+        if entry_id is not None:
+            self.entry_paths[entry_id] = path
+            while len(self.entry_paths) > 8:
+                del self.entry_paths[next(iter(self.entry_paths))]
+        return entry_id
+
+    def _clear_queued_clip(self):
+        self.queued_clip = None
+        self.next_candidate = None
+        if self.player:
+            def clear():
+                self.player.playlist_clear()
+                self.queued_entry = None
+            self.control.submit(clear)
+
+    def on_probed(self, path, info, file_id):
+        """Called from a prober thread whenever a file has been probed."""
+        GLib.idle_add(self._on_probed, path, info, file_id)
+
+    def _on_probed(self, path, info, file_id):
+        self.library.note_probed(path, info, file_id)
+        if info is None or path in self.library.withheld:
+            self.library.sync_quarantine(path)
+        if file_id == self.next_candidate and self.queued_clip is None:
+            if info is None:
+                self.next_candidate = None
+            self._queue_next_clip()
+        return GLib.SOURCE_REMOVE
+
+    def _on_file_loaded(self, path):
+        if self.loading_clip is not None and path == self.loading_clip.path:
+            clip, self.loading_clip = self.loading_clip, None
+        elif self.loading_clip is None and self.queued_clip is not None and path == self.queued_clip.path:
+            # mpv moved on to the queued clip by itself because the current file ended.
+            clip, self.queued_clip = self.queued_clip, None
+            if self.is_locked:
+                print("Locked video finished. Unlocking and playing next clip.")
+                self.is_locked = False
+                self.lock_button.set_label("🔓")
+            else:
+                print("File finished. Playing next clip.")
+        else:
+            # A load that has since been superseded by another one.
+            return GLib.SOURCE_REMOVE
+        if self.playback_stats is not None:
+            # The last sample of the clip that just ended.
+            self.metrics.record('playback', **self.playback_stats)
+            self.playback_stats = None
+        self.current_clip = clip
+        self.library.save_last_clip(clip)
+        self._announce_clip(clip)
+        self._queue_next_clip()
+        return GLib.SOURCE_REMOVE
+
+    def _on_playback_restart(self, position):
+        """mpv has shown the first frame after a load or seek, at `position`; completes the pending switch timing."""
+        timing, clip = self.switch_timing, self.current_clip
+        if timing is None or self.loading_clip is not None or clip is None or self.switches_in_flight:
+            return GLib.SOURCE_REMOVE
+        if position is not None and position + 1 < clip.start_pos:
+            # The file started at 0 before the seek to the clip; wait for the restart after it.
             return GLib.SOURCE_REMOVE
-        if current_pos is not None and hasattr(self, 'end_pos'):
-            if current_pos >= self.end_pos:
-                print("Clip finished. Playing next one.")
-                self.play_random_clip()
+        timing.mark('first_frame')
+        if self.startup_timing is not None:
+            self._report_startup()
+        self.switch_timing = None
+        self.last_switch = timing
+        phases = {f'{phase}_ms': round(ms, 1) for phase, ms in timing.phases.items()}
+        self.metrics.record('clip_switch', trigger=timing.trigger, source=timing.source,
+                            read_ahead_bytes=self.read_ahead.warmed.get(clip.path, 0),
+                            total_ms=round(timing.total_ms(), 1), **phases)
+        print(f"Clip switch took {timing.total_ms():.0f} ms ("
+              + ", ".join(f"{phase} {ms:.0f}" for phase, ms in timing.phases.items()) + ").")
         return GLib.SOURCE_REMOVE
 
+    def _report_startup(self):
+        timing, self.startup_timing = self.startup_timing, None
+        timing.mark('first_frame')
+        total_ms = timing.total_ms()
+        phases = {f'{phase}_ms': round(ms, 1) for phase, ms in timing.phases.items()}
+        self.metrics.record('startup', total_ms=round(total_ms, 1), target_ms=self.STARTUP_TARGET_MS,
+                            resumed=self.resumed, videos=len(self.library.video_files), **phases)
+        print(f"Startup took {total_ms:.0f} ms ("
+              + ", ".join(f"{phase} {ms:.0f}" for phase, ms in timing.phases.items()) + ").")
+        if total_ms > self.STARTUP_TARGET_MS:
+            print(f"Warning: First clip took longer than the {self.STARTUP_TARGET_MS} ms startup target.",
+                  file=sys.stderr)
+
+    def _sample_playback(self):
+        """Samples mpv's dropped-frame and cache counters once a second and refreshes the stats overlay."""
+        if not self.player:
+            return GLib.SOURCE_REMOVE
+        self.control.submit(self._read_playback_stats, self._on_playback_sampled, key='sample')
+        return GLib.SOURCE_CONTINUE
+
+    def _read_playback_stats(self):
+        """Runs on the player-control thread; returns the playing path and its counters."""
+        clip = self.current_clip
+        if clip is None or self.player.path != clip.path:
+            return None
+        # Read as properties: MPV.__getitem__ would look these up as options, which they are not.
+        player = self.player
+        cache = player.demuxer_cache_state or {}
+        return clip.path, {
+            'dropped_frames': player.frame_drop_count or 0,
+            'decoder_dropped_frames': player.decoder_frame_drop_count or 0,
+            'cache_seconds': round(player.demuxer_cache_duration or 0.0, 2),
+            'cache_bytes': cache.get('fw-bytes', 0),
+            'cache_speed': player.cache_speed or 0,
+        }
+
+    def _on_playback_sampled(self, sample):
+        if sample is not None and self.current_clip is not None and sample[0] == self.current_clip.path:
+            self.playback_stats = sample[1]
+        if self.stats_visible:
+            self._draw_stats_overlay()
+
+    def on_toggle_stats(self):
+        if not self.player:
+            return
+        self.stats_visible = not self.stats_visible
+        if self.stats_visible:
+            self._draw_stats_overlay()
+        else:
+            self.control.submit(lambda: self.player.command('osd-overlay', self.STATS_OVERLAY_ID, 'none', ''),
+                                key='overlay')
+
+    def _draw_stats_overlay(self):
+        lines = []
+        timing = self.last_switch
+        if timing is not None:
+            lines.append(f"Last switch ({timing.trigger}, {timing.source}): {timing.total_ms():.0f} ms")
+            lines.append("  " + ", ".join(f"{phase} {ms:.0f}" for phase, ms in timing.phases.items()))
+        switch = self.metrics.percentiles('clip_switch', 'total_ms')
+        if switch[50] is not None:
+            lines.append("Switch p50/p90/p99: " + " / ".join(f"{switch[pct]:.0f}" for pct in sorted(switch)) + " ms")
+        stats = self.playback_stats
+        if stats is not None:
+            lines.append(f"Dropped frames: {stats['dropped_frames']} output, {stats['decoder_dropped_frames']} decoder")
+            lines.append(f"Cache: {stats['cache_seconds']:.1f} s, {stats['cache_bytes'] / 1e6:.1f} MB, "
+                         f"{stats['cache_speed'] / 1e6:.1f} MB/s")
+        if self.library is not None:
+            scan = self.library.last_scan
+            line = f"Library: {len(self.library.video_files)} videos of {len(self.library.library_files)} files"
+            if scan:
+                line += (f", last scan {scan['seconds']:.2f} s ({scan['folders']} folders, "
+                         f"{scan['relisted']} re-listed)")
+            lines.append(line)
+        else:
+            lines.append("Library: loading…")
+        text = r'{\an7\fs16\bord1}' + r'\N'.join(lines)
+        self.control.submit(lambda: self.player.command('osd-overlay', self.STATS_OVERLAY_ID, 'ass-events', text),
+                            key='overlay')
+
+    def _announce_clip(self, clip):
+        filename = os.path.basename(clip.path)
+        self.current_filename = filename
+
+        m, s = divmod(clip.start_pos, 60)
+        h, m = divmod(m, 60)
+        formatted_start_time = f"{int(h):02d}:{int(m):02d}:{int(s):02d}"
+
+        clip_len_seconds = int(clip.end_pos - clip.start_pos)
+        self.current_clip_length = clip_len_seconds
+
+        osd_message = (
+            f"{filename}\n"
+            f"Timestamp: {formatted_start_time} | Duration: {clip_len_seconds}s"
+        )
+        self._show_text(osd_message, 4000)
+
+        self.set_title(f"Serendipity Clip Player - {filename}")
+        print(f"Playing '{filename}'. Start: {clip.start_pos:.2f}s, End: {clip.end_pos:.2f}s")
+
 def main():
-    win = MpvPlayerWindow()
+    startup_timing = SwitchTiming('startup', started=STARTED)
+    startup_timing.mark('imports')
+    win = MpvPlayerWindow(startup_timing)
     win.show_all()
+    startup_timing.mark('window')
     Gtk.main()
 
 if __name__ == "__main__":
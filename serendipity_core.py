@@ -0,0 +1,2157 @@
+"""The headless core of Serendipity Player.
+
+Settings, the library index and watcher, filtering, clip selection, the
+media metadata cache, the quarantine of unplayable files and playback
+metrics live here. Nothing in this module imports GTK, and mpv is only
+imported by the background prober, so it can be driven by benchmarks and
+command-line tools without a display.
+"""
+import os
+import random
+import sys
+import json
+import re
+import math
+import time
+import errno
+import hashlib
+import ctypes
+import select
+import struct
+import codecs
+from collections import deque, namedtuple
+from itertools import accumulate, compress, filterfalse, groupby, islice
+from bisect import bisect_left, bisect_right
+import sqlite3
+from array import array
+import shutil
+import argparse
+import subprocess
+from contextlib import redirect_stdout
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+def default_config_dir():
+    """The same directory GLib.get_user_config_dir() resolves to on Linux."""
+    base = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    return os.path.join(base, 'serendipity-player')
+
+class Settings:
+    """The user's settings, kept in `settings.json` inside the config directory."""
+    DEFAULTS = {
+        'video_library_path': os.path.expanduser('~/Videos'),
+        'additional_library_paths': [],
+        'min_clip_duration': 30,
+        'max_clip_duration': 90,
+        'supported_extensions': ['.mp4', '.mkv', '.avi', '.mov', '.webm', '.flv'],
+        'keyword_filters': '',
+        'exclusion_folders': [],
+        'scan_threads': 8,
+        'probe_workers': 2,
+        'no_repeat_window': 50,
+        'weighted_sampling': False,
+        'watch_library': True,
+        'record_metrics': True,
+        'snap_to_keyframes': False,
+        'keyframe_workers': 1,
+        'read_ahead_bytes': 64 << 20,
+        'resume_last_clip': True,
+        'open_timeout': 5,
+    }
+
+    def __init__(self, config_dir=None):
+        self.config_dir = config_dir or default_config_dir()
+        self.config_file = os.path.join(self.config_dir, 'settings.json')
+        for key, value in self.DEFAULTS.items():
+            # Copy list defaults so that instances never share them.
+            setattr(self, key, list(value) if isinstance(value, list) else value)
+
+    def load(self):
+        if os.path.exists(self.config_file):
+            try:
+                with open(self.config_file, 'r') as f:
+                    config = json.load(f)
+                for key in self.DEFAULTS:
+                    setattr(self, key, config.get(key, getattr(self, key)))
+            except (json.JSONDecodeError, IOError):
+                print(f"Warning: Could not read settings file at {self.config_file}. Using defaults.")
+        else:
+            self.save()
+        return self
+
+    def save(self):
+        os.makedirs(self.config_dir, exist_ok=True)
+        config = {key: getattr(self, key) for key in self.DEFAULTS}
+        with open(self.config_file, 'w') as f:
+            json.dump(config, f, indent=4)
+
+    def library_roots(self):
+        """`video_library_path` followed by `additional_library_paths`.
+
+        Duplicates are dropped, and so is a root that lies inside another
+        one, since its files would otherwise be counted twice.
+        """
+        roots = []
+        for path in [self.video_library_path] + list(self.additional_library_paths):
+            if path and path not in roots:
+                roots.append(path)
+        nested = [root for root in roots if is_excluded(root, [other for other in roots if other != root])]
+        for root in nested:
+            print(f"Warning: Library folder '{root}' is inside another library folder and is skipped.",
+                  file=sys.stderr)
+        return [root for root in roots if root not in nested]
+
+def index_shard_path(config_dir, root):
+    """The index file of library root `root`: each root has its own, named after a hash of its path."""
+    digest = hashlib.sha1(os.fsencode(root)).hexdigest()[:16]
+    return os.path.join(config_dir, f'library-index-{digest}.sqlite3')
+
+def is_excluded(path, exclusion_folders):
+    """True if `path` is one of the excluded folders or lies inside one of them."""
+    return any(path == folder or path.startswith(folder.rstrip(os.sep) + os.sep)
+               for folder in exclusion_folders)
+
+class LibraryFilter:
+    """The keyword and exclusion-folder settings, compiled once into two regexes.
+
+    Filtering runs over the in-memory library with C-level iterators, so a
+    settings change never has to walk the disk again. On a Catalogue, each
+    folder is looked at once and only the names of files in folders that
+    are neither excluded nor matched are searched; see `select`.
+    """
+    EXCLUDED, PASSES, CHECK_FILES = 0, 1, 2
+
+    def __init__(self, keyword_filters, exclusion_folders):
+        keywords = [f.strip().lower() for f in keyword_filters.split(',') if f.strip()]
+        self.keywords = re.compile('|'.join(map(re.escape, keywords))) if keywords else None
+        # ASCII keywords can be searched for in the catalogue's encoded basenames as they are.
+        self.name_keywords = None
+        if keywords and all(keyword.isascii() and os.sep not in keyword for keyword in keywords):
+            self.name_keywords = re.compile(b'|'.join(re.escape(keyword.encode('ascii')) for keyword in keywords))
+        folders = [os.path.normpath(folder).rstrip(os.sep) for folder in exclusion_folders]
+        self.excluded = (re.compile('(?:' + '|'.join(map(re.escape, folders)) + ')' + re.escape(os.sep))
+                         if folders else None)
+        self.passing_of = None
+        self.states = bytearray()
+        self.passing = bytearray()
+
+    def apply(self, paths):
+        """Returns the paths that match a keyword (if any are set) and are not excluded."""
+        if self.excluded is not None:
+            paths = filterfalse(self.excluded.match, paths)
+        if self.keywords is not None:
+            # Match against lowercased copies but keep the original paths.
+            paths = list(paths)
+            paths = compress(paths, map(self.keywords.search, map(str.lower, paths)))
+        return list(paths)
+
+    @property
+    def active(self):
+        return self.excluded is not None or self.keywords is not None
+
+    def select(self, catalogue, file_ids):
+        """Returns the ids from `file_ids` whose files pass, as a new array.
+
+        Whether a catalogue file passes is worked out once, as a flag per
+        file (see `_passing`), so a refilter is a single pass over the ids.
+        """
+        if not self.active:
+            return file_ids[:] if isinstance(file_ids, array) else array('I', file_ids)
+        passing = self._passing(catalogue)
+        return array('I', compress(file_ids, map(passing.__getitem__, file_ids)))
+
+    def _passing(self, catalogue):
+        """A flag per file of `catalogue` telling whether it passes, extended as the catalogue grows.
+
+        Exclusions and keywords are checked once per folder. Only the files of
+        folders that are neither excluded nor matched by a keyword have their
+        names searched, a run of such files at a time.
+        """
+        if self.passing_of is not catalogue:
+            self.passing_of, self.states, self.passing = catalogue, bytearray(), bytearray()
+        states = self.states
+        for prefix in catalogue.dirs[len(states):]:
+            if self.excluded is not None and self.excluded.match(prefix):
+                states.append(self.EXCLUDED)
+            elif self.keywords is None or self.keywords.search(prefix.lower()):
+                states.append(self.PASSES)
+            else:
+                states.append(self.CHECK_FILES)
+        first = len(self.passing)
+        if first < len(catalogue):
+            flags = bytearray()
+            for dir_id, run in groupby(catalogue.file_dir[first:]):
+                flags += states[dir_id:dir_id + 1] * len(list(run))
+            for run in re.finditer(b'%c+' % self.CHECK_FILES, flags):
+                matches = self._keyword_matches(catalogue, first + run.start(), first + run.end())
+                flags[run.start():run.end()] = bytes(run.end() - run.start())
+                for file_id in matches:
+                    flags[file_id - first] = self.PASSES
+            self.passing += flags
+        return self.passing
+
+    def _keyword_matches(self, catalogue, start, stop):
+        """The ids from `start` to `stop` whose files match a keyword, possibly repeated.
+
+        With ASCII keywords and a UTF-8 filesystem encoding, the keywords are
+        searched for in a lowercased copy of that stretch of the catalogue's
+        `names` buffer, and only the matches are mapped back to files.
+        """
+        file_ids = range(start, stop)
+        if self.name_keywords is None or codecs.lookup(catalogue.encoding).name != 'utf-8':
+            return [file_id for file_id in file_ids if self.keywords.search(catalogue.path(file_id).lower())]
+        ends = catalogue.name_ends
+        offset = ends[start - 1] if start else 0
+        names = catalogue.names[offset:ends[stop - 1]].lower()
+        matches = []
+        for match in self.name_keywords.finditer(names):
+            begin, end = match.start() + offset, match.end() + offset
+            file_id = bisect_right(ends, begin, start, stop)
+            if end <= ends[file_id]:
+                matches.append(file_id)
+                continue
+            # The basenames are stored back to back, so a match that runs into
+            # the next one proves nothing and may hide a real match in either.
+            for file_id in range(file_id, bisect_right(ends, end - 1, file_id, stop) + 1):
+                name_start = ends[file_id - 1] if file_id else 0
+                if self.name_keywords.search(names, name_start - offset, ends[file_id] - offset):
+                    matches.append(file_id)
+        return matches
+
+class LibraryIndex:
+    """A persistent SQLite index of the video library.
+
+    Each directory is stored as one row holding its mtime and the names, sizes
+    and mtimes of the video files directly inside it. A rescan only lists
+    directories whose mtime has changed; the contents of unchanged directories
+    are taken straight from the index.
+    """
+    SCHEMA_VERSION = 2
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS dirs (
+            id INTEGER PRIMARY KEY, path BLOB UNIQUE NOT NULL,
+            parent INTEGER, mtime_ns INTEGER NOT NULL,
+            names BLOB NOT NULL, sizes BLOB NOT NULL, mtimes BLOB NOT NULL);
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.last_scan = {}
+
+    def _connect(self):
+        # A fresh connection per call keeps the index usable from any thread.
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        if conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            conn.executescript("DROP TABLE IF EXISTS meta; DROP TABLE IF EXISTS dirs; DROP TABLE IF EXISTS files;")
+            conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        conn.executescript(self.SCHEMA)
+        return conn
+
+    def _check_meta(self, conn, root, extensions):
+        """Drops the whole index if it was built for another root or extension set."""
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        wanted = {'root': root, 'extensions': json.dumps(sorted(extensions))}
+        if all(meta.get(k) == v for k, v in wanted.items()):
+            return
+        conn.execute("DELETE FROM dirs")
+        conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", wanted.items())
+
+    @staticmethod
+    def _pack_files(entries):
+        """Packs (name, size, mtime_ns) entries into the three BLOB columns of a dirs row."""
+        names = '\0'.join(name for name, _, _ in entries)
+        return (os.fsencode(names),
+                array('q', [size for _, size, _ in entries]).tobytes(),
+                array('q', [mtime for _, _, mtime in entries]).tobytes())
+
+    @staticmethod
+    def _visit_dir(path, known_mtime, extensions):
+        """Stats a directory and lists it if its mtime differs from `known_mtime`.
+
+        Runs on a scanner thread. Returns (mtime_ns, listing), where listing is
+        None for an unchanged directory and otherwise a tuple of subdirectory
+        paths and (name, size, mtime_ns) video entries.
+        """
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return None, None
+        if mtime_ns == known_mtime:
+            return mtime_ns, None
+        subdirs, files = [], []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                subdirs.append(entry.path)
+                        elif entry.name.lower().endswith(extensions):
+                            st = entry.stat()
+                            files.append((entry.name, st.st_size, st.st_mtime_ns))
+                    except OSError:
+                        continue
+        except OSError as e:
+            print(f"Warning: Could not list '{path}': {e}", file=sys.stderr)
+        return mtime_ns, (subdirs, files)
+
+    def rescan(self, root, extensions, exclusions=(), on_batch=None, cancel=None,
+               batch_size=500, workers=8, on_changes=None, flush_interval=0.25):
+        """Brings the index up to date with the disk and returns every folder with video files in it.
+
+        Folders come back as blocks in the packed form of `cached_blocks`.
+        Directories are visited concurrently by `workers` threads, which hides
+        the per-directory latency of network mounts. Excluded folders are pruned
+        before they are descended into. If given, `on_batch` is called with each
+        new list of blocks as the walk progresses: the first files as soon as
+        they are found, then every `batch_size` files or `flush_interval`
+        seconds, whichever comes first. Setting the `cancel` event
+        stops the walk early; directories that were not reached are then left
+        untouched in the index. After a complete walk, `on_changes` is called
+        with the lists of video paths added to and removed from the index;
+        files whose size or mtime changed are among the added ones.
+        """
+        extensions = tuple(sorted({ext.lower() for ext in extensions}))
+        exclusions = [os.path.normpath(folder) for folder in exclusions]
+        fs_encoding, fs_errors = sys.getfilesystemencoding(), sys.getfilesystemencodeerrors()
+        conn = self._connect()
+        try:
+            with conn:
+                self._check_meta(conn, root, extensions)
+                known = {}
+                children = {}
+                packed_by_dir = {}
+                for dir_id, path, parent, mtime_ns, names, sizes, mtimes in conn.execute(
+                        "SELECT id, path, parent, mtime_ns, names, sizes, mtimes FROM dirs"):
+                    path = path.decode(fs_encoding, fs_errors)
+                    known[path] = (dir_id, mtime_ns)
+                    children.setdefault(parent, []).append(path)
+                    if names:
+                        packed_by_dir[dir_id] = (names, sizes, mtimes)
+
+                def names_in(dir_id):
+                    names = packed_by_dir.get(dir_id, (b'',))[0]
+                    return names.decode(fs_encoding, fs_errors).split('\0') if names else []
+
+                def stamps_in(dir_id):
+                    if dir_id not in packed_by_dir:
+                        return {}
+                    _, sizes, mtimes = packed_by_dir[dir_id]
+                    return dict(zip(names_in(dir_id), zip(array('q', sizes), array('q', mtimes))))
+
+                seen = set()
+                result = []
+                added, removed = [], []
+                flushed = unflushed_files = 0
+                last_flush = time.monotonic()
+                relisted = 0
+                cancelled = False
+
+                with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                    pending = {}
+
+                    def descend(path, parent_id):
+                        dir_id, known_mtime = known.get(path, (None, None))
+                        if not is_excluded(path, exclusions):
+                            future = pool.submit(self._visit_dir, path, known_mtime, extensions)
+                            pending[future] = (path, parent_id, dir_id)
+                            return
+                        # Keep an empty placeholder row for the excluded folder so that
+                        # it is picked up again if the exclusion is later removed.
+                        if dir_id is None:
+                            dir_id = conn.execute(
+                                "INSERT INTO dirs (path, parent, mtime_ns, names, sizes, mtimes) "
+                                "VALUES (?, ?, -1, ?, ?, ?)",
+                                (os.fsencode(path), parent_id) + self._pack_files([])).lastrowid
+                        elif known_mtime != -1:
+                            prefix = os.path.join(path, '')
+                            removed.extend(prefix + name for name in names_in(dir_id))
+                            conn.execute(
+                                "UPDATE dirs SET mtime_ns = -1, names = ?, sizes = ?, mtimes = ? WHERE id = ?",
+                                self._pack_files([]) + (dir_id,))
+                        seen.add(dir_id)
+
+                    def found(directory, names, sizes, mtimes):
+                        nonlocal unflushed_files
+                        result.append((directory, names, sizes, mtimes))
+                        unflushed_files += names.count(b'\0') + 1
+
+                    def flush():
+                        nonlocal flushed, unflushed_files, last_flush
+                        if on_batch and len(result) > flushed and (
+                                not flushed or unflushed_files >= batch_size
+                                or time.monotonic() - last_flush >= flush_interval):
+                            on_batch(result[flushed:])
+                            flushed, unflushed_files = len(result), 0
+                            last_flush = time.monotonic()
+
+                    descend(root, None)
+                    while pending:
+                        if cancel is not None and cancel.is_set():
+                            cancelled = True
+                            for future in pending:
+                                future.cancel()
+                            break
+                        # Woken up regularly, so that a folder that takes long to list does not hold back a flush.
+                        done, _ = wait(pending, timeout=flush_interval, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            flush()
+                            path, parent_id, dir_id = pending.pop(future)
+                            mtime_ns, listing = future.result()
+                            if mtime_ns is None:
+                                continue
+                            if listing is None:
+                                # Unchanged directory: trust the index.
+                                seen.add(dir_id)
+                                if dir_id in packed_by_dir:
+                                    found(path, *packed_by_dir[dir_id])
+                                for child in children.get(dir_id, ()):
+                                    descend(child, dir_id)
+                                continue
+
+                            relisted += 1
+                            subdirs, entries = listing
+                            prefix = os.path.join(path, '')
+                            if on_changes:
+                                # A file whose size or mtime changed was replaced, and counts as added.
+                                old_stamps = stamps_in(dir_id)
+                                added.extend(prefix + name for name, size, mtime_ns in entries
+                                             if old_stamps.get(name) != (size, mtime_ns))
+                                new_names = {name for name, _, _ in entries}
+                                removed.extend(prefix + name for name in old_stamps.keys() - new_names)
+                            packed = self._pack_files(entries)
+                            if dir_id is None:
+                                dir_id = conn.execute(
+                                    "INSERT INTO dirs (path, parent, mtime_ns, names, sizes, mtimes) "
+                                    "VALUES (?, ?, ?, ?, ?, ?)",
+                                    (os.fsencode(path), parent_id, mtime_ns) + packed).lastrowid
+                            else:
+                                conn.execute(
+                                    "UPDATE dirs SET parent = ?, mtime_ns = ?, names = ?, sizes = ?, mtimes = ? "
+                                    "WHERE id = ?", (parent_id, mtime_ns) + packed + (dir_id,))
+                            seen.add(dir_id)
+                            if entries:
+                                found(path, *packed)
+                            for child in subdirs:
+                                descend(child, dir_id)
+                        flush()
+
+                if on_batch and len(result) > flushed:
+                    on_batch(result[flushed:])
+                gone = [] if cancelled else [(dir_id,) for dir_id, _ in known.values() if dir_id not in seen]
+                conn.executemany("DELETE FROM dirs WHERE id = ?", gone)
+                if on_changes and gone:
+                    paths_by_id = {dir_id: path for path, (dir_id, _) in known.items()}
+                    for (dir_id,) in gone:
+                        prefix = os.path.join(paths_by_id[dir_id], '')
+                        removed.extend(prefix + name for name in names_in(dir_id))
+        finally:
+            conn.close()
+        self.last_scan = {'folders': len(seen), 'relisted': relisted, 'removed_folders': len(gone)}
+        print(f"Library index: {len(seen)} folders, {relisted} re-listed, {len(gone)} removed.")
+        if on_changes and not cancelled:
+            on_changes(added, removed)
+        return result
+
+    def cached_blocks(self, root, extensions):
+        """Returns what the last scan of `root` recorded, without touching the library itself.
+
+        Each folder comes back packed as it is stored: (path, names, sizes,
+        mtimes), ready for `Catalogue.add_block`. Returns an empty list if the
+        index was built for another root or extension set.
+        """
+        extensions = tuple(sorted({ext.lower() for ext in extensions}))
+        conn = self._connect()
+        try:
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            if meta.get('root') != root or meta.get('extensions') != json.dumps(sorted(extensions)):
+                return []
+            return [(os.fsdecode(path), names, sizes, mtimes) for path, names, sizes, mtimes in conn.execute(
+                "SELECT path, names, sizes, mtimes FROM dirs WHERE mtime_ns != -1 AND length(names) > 0")]
+        finally:
+            conn.close()
+
+    def directories(self):
+        """Returns the paths of all indexed folders, leaving out excluded placeholders."""
+        conn = self._connect()
+        try:
+            return [os.fsdecode(path) for (path,) in conn.execute("SELECT path FROM dirs WHERE mtime_ns != -1")]
+        finally:
+            conn.close()
+
+class LibraryWatcher:
+    """Follows changes below the library root while the player runs.
+
+    Every indexed folder gets an inotify watch. Finished downloads, moves and
+    deletions are reported about once a second through
+    `on_change(added, removed, removed_dirs)`. If inotify is unavailable or
+    the kernel's watch limit is reached, the watcher falls back to an
+    incremental index rescan every `poll_interval` seconds; that only stats
+    folders and re-lists the ones whose mtime changed.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                  IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, library_index, root, extensions, exclusions, on_change,
+                 scan_threads=8, poll_interval=300):
+        self.library_index = library_index
+        self.root = root
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.exclusions = [os.path.normpath(folder) for folder in exclusions]
+        self.on_change = on_change
+        self.scan_threads = scan_threads
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.libc = None
+        self.fd = -1
+        self.watches = {}
+        self.created = set()
+        self.added, self.removed, self.removed_dirs = set(), set(), set()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        try:
+            if self._start_inotify():
+                self._watch_loop()
+        except OSError as e:
+            print(f"Warning: Library watcher failed: {e}", file=sys.stderr)
+        finally:
+            if self.fd >= 0:
+                os.close(self.fd)
+                self.fd = -1
+        if not self.stop_event.is_set():
+            print(f"Checking the library for changes every {self.poll_interval}s instead.")
+            self._poll_loop()
+
+    def _start_inotify(self):
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            print("Warning: inotify is not available.", file=sys.stderr)
+            return False
+        if self.fd < 0:
+            print(f"Warning: inotify_init1 failed: {os.strerror(ctypes.get_errno())}", file=sys.stderr)
+            return False
+        for path in self.library_index.directories():
+            if not self._add_watch(path):
+                return False
+        print(f"Watching {len(self.watches)} library folders for changes.")
+        return True
+
+    def _add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = path
+            return True
+        err = ctypes.get_errno()
+        if err in (errno.ENOSPC, errno.ENOMEM):
+            print("Warning: inotify watch limit reached (see fs.inotify.max_user_watches).", file=sys.stderr)
+            return False
+        # The folder vanished or is unreadable; nothing to watch.
+        return True
+
+    def _watch_tree(self, top):
+        """Watches a newly appeared folder and everything below it, reporting the videos inside."""
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            if is_excluded(path, self.exclusions):
+                continue
+            if not self._add_watch(path):
+                return False
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.lower().endswith(self.extensions):
+                            self.added.add(entry.path)
+            except OSError:
+                continue
+        return True
+
+    def _forget_tree(self, top):
+        """Drops the watches and pending additions of a folder that was deleted or moved away."""
+        prefix = os.path.join(top, '')
+        for wd, path in list(self.watches.items()):
+            if path == top or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+        self.added = {path for path in self.added if not path.startswith(prefix)}
+        self.created = {path for path in self.created if not path.startswith(prefix)}
+        self.removed_dirs.add(top)
+
+    def _watch_loop(self):
+        last_flush = time.monotonic()
+        while not self.stop_event.is_set():
+            readable, _, _ = select.select([self.fd], [], [], 1.0)
+            if readable and not self._handle_events(os.read(self.fd, 64 * 1024)):
+                return
+            if time.monotonic() - last_flush >= 1.0:
+                self._flush()
+                last_flush = time.monotonic()
+
+    def _handle_events(self, data):
+        """Updates the pending changes from a buffer of inotify events; False means fall back to polling."""
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost: let an index rescan work out what changed.
+                self.library_index.rescan(self.root, self.extensions, self.exclusions, workers=self.scan_threads,
+                                          on_changes=lambda added, removed: self.on_change(added, removed, []))
+                continue
+            dir_path = self.watches.get(wd)
+            if dir_path is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if not name:
+                continue
+            path = os.path.join(dir_path, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    if not self._watch_tree(path):
+                        return False
+                elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                    self._forget_tree(path)
+            elif name.lower().endswith(self.extensions):
+                if mask & self.IN_CREATE:
+                    # Only report it once it has been written and closed.
+                    self.created.add(path)
+                elif mask & self.IN_MOVED_TO or (mask & self.IN_CLOSE_WRITE and path in self.created):
+                    self.created.discard(path)
+                    self.added.add(path)
+                    self.removed.discard(path)
+                elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                    self.created.discard(path)
+                    self.added.discard(path)
+                    self.removed.add(path)
+        return True
+
+    def _flush(self):
+        if not (self.added or self.removed or self.removed_dirs):
+            return
+        self.on_change(sorted(self.added), sorted(self.removed), sorted(self.removed_dirs))
+        self.added, self.removed, self.removed_dirs = set(), set(), set()
+
+    def _poll_loop(self):
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                self.library_index.rescan(self.root, self.extensions, self.exclusions, workers=self.scan_threads,
+                                          on_changes=self._report_poll_changes)
+            except Exception as e:
+                print(f"Warning: Library check failed: {e}", file=sys.stderr)
+
+    def _report_poll_changes(self, added, removed):
+        if added or removed:
+            self.on_change(added, removed, [])
+
+MediaInfo = namedtuple('MediaInfo', 'size mtime_ns duration container streams')
+QuarantineEntry = namedtuple('QuarantineEntry', 'mtime_ns failures retry_at reason')
+Clip = namedtuple('Clip', 'path start_pos end_pos keyframe file_id', defaults=(False, -1))
+
+def clip_options(clip):
+    """The loadfile options that make mpv play just `clip`."""
+    options = {'start': f'{clip.start_pos:.3f}', 'end': f'{clip.end_pos:.3f}'}
+    if clip.keyframe:
+        # The start is a keyframe, so a plain demuxer seek lands on it without decoding up to it.
+        options['hr_seek'] = 'no'
+    return options
+
+class MetadataCache:
+    """Persistent per-file media metadata, keyed by path, size and mtime.
+
+    Nothing per file is held here: the durations needed at pick time are
+    copied into the library's Catalogue a folder at a time with
+    `block_durations`, and single lookups read SQLite under a lock. Only
+    the running total behind `mean_duration` is kept in memory.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS media (
+            path BLOB PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+            duration REAL, container TEXT, streams TEXT);
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.conn.executescript(self.SCHEMA)
+        self.version = 0
+        self.durations_known, self.total_duration = self.conn.execute(
+            "SELECT count(*), total(duration) FROM media WHERE duration > 0").fetchone()
+
+    def mean_duration(self, default=1800.0):
+        """The average known duration, used as a stand-in for files not probed yet."""
+        return self.total_duration / self.durations_known if self.durations_known else default
+
+    def get(self, path):
+        """Returns the cached MediaInfo for `path`, or None if it has not been probed yet."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, duration, container, streams FROM media WHERE path = ?",
+                (os.fsencode(path),)).fetchone()
+        return MediaInfo(*row) if row is not None else None
+
+    def block_durations(self, directory, names, sizes, mtimes):
+        """The cached durations of one folder's files, packed for `Catalogue.add_block`.
+
+        The arguments are a LibraryIndex block. A file whose size or mtime no
+        longer matches its cache entry gets 0, like one never probed.
+        """
+        prefix = os.fsencode(os.path.join(directory, ''))
+        position = {name: i for i, name in enumerate(names.split(b'\0'))}
+        sizes, mtimes = array('q', sizes), array('q', mtimes)
+        durations = array('f', bytes(4 * len(position)))
+        with self.lock:
+            # The folder's rows are a range of the primary key; rows from subfolders are skipped.
+            rows = self.conn.execute(
+                "SELECT substr(path, ?1), size, mtime_ns, duration FROM media "
+                "WHERE path >= ?2 AND path < ?3 AND instr(substr(path, ?1), ?4) = 0 AND duration > 0",
+                (len(prefix) + 1, prefix, prefix[:-1] + bytes((prefix[-1] + 1,)), os.fsencode(os.sep))).fetchall()
+        for name, size, mtime_ns, duration in rows:
+            i = position.get(name)
+            if i is not None and sizes[i] == size and mtimes[i] == mtime_ns:
+                durations[i] = duration
+        return durations.tobytes()
+
+    def put(self, path, info):
+        with self.lock:
+            old = self.conn.execute("SELECT duration FROM media WHERE path = ?", (os.fsencode(path),)).fetchone()
+            if old is not None and old[0]:
+                self.total_duration -= old[0]
+                self.durations_known -= 1
+            if info.duration:
+                self.total_duration += info.duration
+                self.durations_known += 1
+            self.version += 1
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO media (path, size, mtime_ns, duration, container, streams) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", (os.fsencode(path),) + tuple(info))
+
+class Quarantine:
+    """Files that failed to open or play, kept out of the selection until a retry is due.
+
+    Each further failure doubles the wait before the next retry, from
+    RETRY_BASE up to RETRY_MAX. Once its retry is due a file is selectable
+    again, but it stays on probation: the entry and its failure count are
+    kept until the player has seen it play to the end of a clip, so a file
+    that keeps failing backs off further each time. Entries remember the
+    file's mtime when it is known, and a file that has changed on disk is
+    released straight away.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS quarantine (
+            path BLOB PRIMARY KEY, mtime_ns INTEGER NOT NULL, failures INTEGER NOT NULL,
+            retry_at REAL NOT NULL, reason TEXT);
+    """
+    RETRY_BASE = 600
+    RETRY_MAX = 7 * 24 * 3600
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.conn.executescript(self.SCHEMA)
+        self.entries = {
+            os.fsdecode(path): QuarantineEntry(mtime_ns, failures, retry_at, reason)
+            for path, mtime_ns, failures, retry_at, reason in self.conn.execute(
+                "SELECT path, mtime_ns, failures, retry_at, reason FROM quarantine")
+        }
+        self.retrying = set()
+
+    def is_active(self, path):
+        """True while `path` is quarantined and its next retry is not due yet."""
+        entry = self.entries.get(path)
+        return entry is not None and time.time() < entry.retry_at
+
+    def add(self, path, reason, mtime_ns=-1):
+        """Records a failure of `path`; `mtime_ns` is -1 when the file could not be stat'ed."""
+        with self.lock:
+            old = self.entries.get(path)
+            failures = 1
+            if old is not None and (old.mtime_ns == mtime_ns or -1 in (old.mtime_ns, mtime_ns)):
+                failures = old.failures + 1
+                if mtime_ns == -1:
+                    mtime_ns = old.mtime_ns
+            delay = min(self.RETRY_BASE * 2 ** (failures - 1), self.RETRY_MAX)
+            entry = QuarantineEntry(mtime_ns, failures, time.time() + delay, reason)
+            self.entries[path] = entry
+            self.retrying.discard(path)
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO quarantine (path, mtime_ns, failures, retry_at, reason) "
+                    "VALUES (?, ?, ?, ?, ?)", (os.fsencode(path),) + tuple(entry))
+        print(f"Quarantined '{path}' ({reason}); retrying in {delay // 60} min.", file=sys.stderr)
+
+    def release(self, path):
+        if path not in self.entries:
+            return
+        with self.lock:
+            self.entries.pop(path, None)
+            self.retrying.discard(path)
+            with self.conn:
+                self.conn.execute("DELETE FROM quarantine WHERE path = ?", (os.fsencode(path),))
+        print(f"Released '{path}' from quarantine.")
+
+    def check_mtime(self, path, mtime_ns):
+        """Releases `path` if it has changed on disk since it was quarantined."""
+        entry = self.entries.get(path)
+        if entry is not None and entry.mtime_ns not in (-1, mtime_ns):
+            self.release(path)
+
+    def due(self):
+        """Returns the quarantined paths whose retry has come up since the last call."""
+        now = time.time()
+        with self.lock:
+            paths = [path for path, entry in self.entries.items()
+                     if entry.retry_at <= now and path not in self.retrying]
+            self.retrying.update(paths)
+        return paths
+
+class WorkQueue:
+    """Background worker threads fed from an urgent queue and a randomly ordered backlog.
+
+    Paths passed to `request` are handled first; the backlog is worked
+    through in random order. A backlog set from a CatalogueView is kept as
+    its array of ids, and paths are only built as they are taken.
+    Subclasses implement `_worker`, which takes (path, file_id) pairs from
+    `_next_entry` until it returns None. The file id is the path's catalogue
+    id, or -1 if it came without one.
+    """
+    def __init__(self, workers=1):
+        self.cond = threading.Condition()
+        self.urgent = deque()
+        self.backlog = []
+        self.backlog_ids = array('I')
+        self.catalogue = None
+        self.stopped = False
+        for _ in range(max(1, workers)):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def request(self, path, file_id=-1):
+        """Moves `path`, with its catalogue id if known, to the front of the queue."""
+        with self.cond:
+            self.urgent.append((path, file_id))
+            self.cond.notify()
+
+    def set_backlog(self, paths):
+        """Replaces the background work list with `paths`, a list of paths or a CatalogueView."""
+        with self.cond:
+            if isinstance(paths, CatalogueView):
+                self.backlog, self.backlog_ids, self.catalogue = [], array('I', paths.ids), paths.catalogue
+            else:
+                self.backlog, self.backlog_ids = list(paths), array('I')
+            self.cond.notify_all()
+
+    def extend_backlog(self, paths):
+        """Adds `paths`, a list of paths or a CatalogueView, to the background work list."""
+        with self.cond:
+            if isinstance(paths, CatalogueView):
+                if paths.catalogue is not self.catalogue:
+                    # Ids of an earlier catalogue name other files in this one.
+                    self.backlog_ids, self.catalogue = array('I'), paths.catalogue
+                self.backlog_ids.extend(paths.ids)
+            else:
+                self.backlog.extend(paths)
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def _next_entry(self):
+        with self.cond:
+            while not self.stopped:
+                if self.urgent:
+                    return self.urgent.popleft()
+                for backlog in (self.backlog, self.backlog_ids):
+                    if backlog:
+                        # Swap-pop a random entry: O(1) and no up-front shuffle of the whole library.
+                        i = random.randrange(len(backlog))
+                        backlog[i], backlog[-1] = backlog[-1], backlog[i]
+                        entry = backlog.pop()
+                        return (self.catalogue.path(entry), entry) if backlog is self.backlog_ids else (entry, -1)
+                self.cond.wait()
+        return None
+
+    def _worker(self):
+        raise NotImplementedError
+
+class MediaProber(WorkQueue):
+    """A pool of headless mpv instances that fills a MetadataCache in the background.
+
+    Files whose size and mtime still match the cache are skipped. Files that
+    cannot be opened within `timeout` seconds, or have no duration, are put
+    in `quarantine` if one is given, and skipped while they are in it.
+    Each file is reported to `on_probed(path, info, file_id)`, with None
+    for `info` if it could not be probed.
+    """
+    def __init__(self, cache, workers=2, timeout=15, on_probed=None, quarantine=None):
+        self.cache = cache
+        self.quarantine = quarantine
+        self.on_probed = on_probed
+        self.timeout = timeout
+        super().__init__(workers)
+
+    def _worker(self):
+        player = None
+        while True:
+            entry = self._next_entry()
+            if entry is None:
+                break
+            path, file_id = entry
+            quarantine = self.quarantine
+            if quarantine is not None and quarantine.is_active(path):
+                if self.on_probed:
+                    self.on_probed(path, None, file_id)
+                continue
+            mtime_ns = -1
+            try:
+                st = os.stat(path)
+                mtime_ns = st.st_mtime_ns
+                if quarantine is not None:
+                    quarantine.check_mtime(path, mtime_ns)
+                info = self.cache.get(path)
+                if info is None or (info.size, info.mtime_ns) != (st.st_size, st.st_mtime_ns):
+                    if player is None:
+                        import mpv
+                        player = mpv.MPV(vo='null', ao='null', pause=True, idle=True,
+                                         ytdl=False, load_scripts=False, osc=False)
+                    info = self._probe(player, path, st)
+                    self.cache.put(path, info)
+                if not info.duration:
+                    # A quarantined file that probes fine stays on probation, see Quarantine.
+                    raise ValueError("no duration")
+            except Exception as e:
+                print(f"Warning: Could not probe '{path}': {e}", file=sys.stderr)
+                if quarantine is not None:
+                    quarantine.add(path, str(e) or type(e).__name__, mtime_ns)
+                info = None
+            if self.on_probed:
+                self.on_probed(path, info, file_id)
+        if player is not None:
+            player.terminate()
+
+    def _probe(self, player, path, st):
+        player.loadfile(path, 'replace')
+        try:
+            player.wait_for_property('duration', timeout=self.timeout)
+            duration = player.duration
+            streams = [
+                {key: track.get(key) for key in ('type', 'codec', 'lang', 'demux-w', 'demux-h')}
+                for track in (player.track_list or [])
+            ]
+            return MediaInfo(st.st_size, st.st_mtime_ns, duration, player.file_format, json.dumps(streams))
+        finally:
+            player.command('stop')
+
+class KeyframeIndex:
+    """Keyframe times and byte offsets of the video stream of each file, kept in SQLite.
+
+    A long file can have thousands of keyframes, so only the size and mtime
+    of indexed files are held in memory; `get` reads one file's keyframes
+    from disk when a clip is planned. Times are relative to the container's
+    start time, as mpv's are.
+    """
+    # 1: times relative to the start time instead of ffprobe's absolute ones.
+    SCHEMA_VERSION = 1
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS keyframes (
+            path BLOB PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+            times BLOB NOT NULL, positions BLOB NOT NULL);
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self.conn.executescript("DROP TABLE IF EXISTS keyframes;")
+            self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.conn.executescript(self.SCHEMA)
+        self.stamps = {
+            os.fsdecode(path): (size, mtime_ns)
+            for path, size, mtime_ns in self.conn.execute("SELECT path, size, mtime_ns FROM keyframes")
+        }
+
+    def is_fresh(self, path, size, mtime_ns):
+        return self.stamps.get(path) == (size, mtime_ns)
+
+    def get(self, path):
+        """Returns (times, positions) arrays for `path`, sorted by time, or None if it is not indexed."""
+        if path not in self.stamps:
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT times, positions FROM keyframes WHERE path = ?", (os.fsencode(path),)).fetchone()
+        if row is None:
+            return None
+        times, positions = array('d'), array('q')
+        times.frombytes(row[0])
+        positions.frombytes(row[1])
+        return times, positions
+
+    def put(self, path, size, mtime_ns, times, positions):
+        with self.lock:
+            self.stamps[path] = (size, mtime_ns)
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO keyframes (path, size, mtime_ns, times, positions) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (os.fsencode(path), size, mtime_ns, times.tobytes(), positions.tobytes()))
+
+class KeyframeIndexer(WorkQueue):
+    """Fills a KeyframeIndex in the background using ffprobe.
+
+    ffprobe only demuxes the video stream's packets and nothing is decoded,
+    but every packet header is still read, so a file takes about as long as
+    reading it once. Files whose size and mtime match the index are skipped.
+    """
+    COMMAND = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+               '-show_entries', 'packet=pts_time,pos,flags:format=start_time', '-of', 'csv=p=1']
+
+    def __init__(self, index, workers=1, timeout=600):
+        self.index = index
+        self.timeout = timeout
+        super().__init__(workers)
+
+    @staticmethod
+    def available():
+        return shutil.which('ffprobe') is not None
+
+    def _worker(self):
+        while True:
+            entry = self._next_entry()
+            if entry is None:
+                break
+            path, _ = entry
+            try:
+                st = os.stat(path)
+                if not self.index.is_fresh(path, st.st_size, st.st_mtime_ns):
+                    times, positions = self._read_keyframes(path)
+                    self.index.put(path, st.st_size, st.st_mtime_ns, times, positions)
+            except Exception as e:
+                print(f"Warning: Could not index keyframes of '{path}': {e}", file=sys.stderr)
+
+    def _read_keyframes(self, path):
+        output = subprocess.run(self.COMMAND + [path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                timeout=self.timeout, check=True).stdout
+        keyframes = []
+        start_time = 0.0
+        for line in output.decode('ascii', 'replace').splitlines():
+            section, _, fields = line.partition(',')
+            if section == 'format':
+                # ffprobe's times are the container's own; mpv counts from its start time, which is not always 0.
+                try:
+                    start_time = float(fields)
+                except ValueError:
+                    pass
+                continue
+            pts_time, pos, flags = (fields.split(',') + ['', ''])[:3]
+            if section != 'packet' or 'K' not in flags:
+                continue
+            try:
+                keyframes.append((float(pts_time), int(pos) if pos.isdigit() else -1))
+            except ValueError:
+                continue
+        keyframes.sort()
+        return array('d', (t - start_time for t, _ in keyframes)), array('q', (p for _, p in keyframes))
+
+class ReadAhead:
+    """Warms the page cache for the start of the next clip in a background thread.
+
+    Where posix_fadvise is available the ranges are handed to the kernel
+    with POSIX_FADV_WILLNEED; elsewhere they are read in chunks and thrown
+    away. Only the latest request matters: a new one supersedes a read
+    that has not finished yet. `warmed` maps recently prefetched paths to
+    the number of bytes requested.
+    """
+    CHUNK = 1 << 20
+    KEEP = 8
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = None
+        self.generation = 0
+        self.warmed = {}
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def prefetch(self, path, ranges):
+        """Queues (offset, length) ranges of `path` to be read ahead."""
+        with self.cond:
+            self.generation += 1
+            self.pending = (path, ranges)
+            self.cond.notify()
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                (path, ranges), self.pending = self.pending, None
+                generation = self.generation
+            done = 0
+            try:
+                with open(path, 'rb', buffering=0) as f:
+                    for offset, length in ranges:
+                        if hasattr(os, 'posix_fadvise'):
+                            os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+                            done += length
+                            continue
+                        f.seek(offset)
+                        end = offset + length
+                        while offset < end and generation == self.generation:
+                            chunk = f.read(min(self.CHUNK, end - offset))
+                            if not chunk:
+                                break
+                            offset += len(chunk)
+                            done += len(chunk)
+            except OSError as e:
+                print(f"Warning: Could not read ahead '{path}': {e}", file=sys.stderr)
+            self.warmed[path] = done
+            while len(self.warmed) > self.KEEP:
+                del self.warmed[next(iter(self.warmed))]
+
+class CommandQueue:
+    """Runs commands one at a time, in order, on a worker thread of their own.
+
+    The player sends all its mpv calls through one of these, so that a slow
+    file open never blocks the UI and no input is lost meanwhile. A command
+    submitted with a `key` while another one with the same key is still
+    waiting takes its place in the queue, so only the latest of a burst of
+    OSD updates runs. `pending(key)` lets a caller merge into the waiting
+    command instead, as five presses of "next" should be one skip.
+
+    Results are handed to `on_done` through `post`, such as GLib.idle_add,
+    so that they arrive on the UI thread. A command that raises gets None.
+    """
+    def __init__(self, post=None):
+        self.post = post or (lambda fn, *args: fn(*args))
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.waiting = {}
+        self.stopped = False
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, command, on_done=None, key=None):
+        with self.cond:
+            entry = self.waiting.get(key) if key is not None else None
+            if entry is not None:
+                entry[1:] = [command, on_done]
+                return
+            entry = [key, command, on_done]
+            self.queue.append(entry)
+            if key is not None:
+                self.waiting[key] = entry
+            self.cond.notify()
+
+    def after(self, callback, *args):
+        """Posts `callback(*args)` once every command submitted before it has run."""
+        self.submit(lambda: args, lambda args: callback(*args))
+
+    def pending(self, key):
+        """True while a command with `key` is waiting to run; one that is already running does not count."""
+        return key in self.waiting
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    @staticmethod
+    def _deliver(on_done, result):
+        on_done(result)
+        # Run once, even when posted with GLib.idle_add.
+        return False
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                key, command, on_done = self.queue.popleft()
+                if key is not None:
+                    del self.waiting[key]
+            try:
+                result = command()
+            except Exception as e:
+                print(f"Warning: Player command failed: {e}", file=sys.stderr)
+                result = None
+            if on_done is not None:
+                self.post(self._deliver, on_done, result)
+
+class Catalogue:
+    """Every file the library knows about, packed into typed arrays and addressed by id.
+
+    Folder paths are interned in `dirs`. A file is its folder's id (array
+    'I'), the end of its basename in the shared `names` buffer (array 'Q'),
+    an alive flag, its size and mtime (array 'q') and its duration (array
+    'f'). Basenames are kept as filesystem-encoded bytes. That is 33 bytes
+    plus the basename per file, against 100 to 150 bytes for a path string
+    in a list. With the views and a few ranges per folder in `by_dir`, a
+    library of a million files with 21-byte basenames takes about 75 bytes
+    per file. Full paths are built on access.
+
+    Ids never change. Removing a file only clears its alive flag, and the
+    space is reclaimed when the library is reset for the next full scan.
+    Sizes and mtimes are -1 for files that were added by path alone, and
+    durations are 0 until the file's cached duration is known to match.
+    """
+    def __init__(self):
+        self.encoding, self.errors = sys.getfilesystemencoding(), sys.getfilesystemencodeerrors()
+        self.dirs = []
+        self.dir_ids = {}
+        self.file_dir = array('I')
+        self.name_ends = array('Q')
+        self.names = bytearray()
+        self.alive = bytearray()
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self.durations = array('f')
+        # Folder id -> ranges of file ids; files arrive a folder at a time, so there are few.
+        self.by_dir = {}
+
+    def __len__(self):
+        return len(self.file_dir)
+
+    def _dir_id(self, prefix):
+        dir_id = self.dir_ids.get(prefix)
+        if dir_id is None:
+            dir_id = self.dir_ids[prefix] = len(self.dirs)
+            self.dirs.append(prefix)
+        return dir_id
+
+    def _add_run(self, dir_id, first, count):
+        runs = self.by_dir.setdefault(dir_id, [])
+        if runs and runs[-1].stop == first:
+            runs[-1] = range(runs[-1].start, first + count)
+        else:
+            runs.append(range(first, first + count))
+
+    def add_paths(self, paths):
+        """Appends `paths` and returns their ids.
+
+        A run of paths from the same folder, as a scan delivers them, costs
+        a single folder lookup.
+        """
+        heads, encoded = [], []
+        for path in paths:
+            head, _, name = path.rpartition(os.sep)
+            heads.append(head)
+            encoded.append(name.encode(self.encoding, self.errors))
+        end = len(self.names)
+        for name in encoded:
+            end += len(name)
+            self.name_ends.append(end)
+        self.names += b''.join(encoded)
+        first = file_id = len(self.file_dir)
+        for head, run in groupby(heads):
+            count = len(list(run))
+            dir_id = self._dir_id(head + os.sep)
+            self.file_dir += array('I', (dir_id,)) * count
+            self._add_run(dir_id, file_id, count)
+            file_id += count
+        count = file_id - first
+        self.alive += b'\1' * count
+        self.sizes += array('q', (-1,)) * count
+        self.mtimes += array('q', (-1,)) * count
+        self.durations += array('f', bytes(4 * count))
+        return range(first, file_id)
+
+    def add_block(self, directory, names, sizes, mtimes, durations=None):
+        """Appends one folder's files in the packed form of a LibraryIndex row and returns their ids.
+
+        `names` is the NUL-joined, filesystem-encoded basenames; `sizes` and
+        `mtimes` are the raw bytes of array('q')s, and `durations`, if known,
+        of an array('f'), as `MetadataCache.block_durations` returns them. No
+        path strings are made.
+        """
+        if not names:
+            return range(0)
+        dir_id = self._dir_id(os.path.join(directory, ''))
+        first = len(self.file_dir)
+        lengths = map(len, names.split(b'\0'))
+        self.name_ends.extend(islice(accumulate(lengths, initial=len(self.names)), 1, None))
+        self.names += names.replace(b'\0', b'')
+        count = len(self.name_ends) - first
+        self.file_dir += array('I', (dir_id,)) * count
+        self.alive += b'\1' * count
+        self.sizes.frombytes(sizes)
+        self.mtimes.frombytes(mtimes)
+        self.durations.frombytes(durations or bytes(4 * count))
+        self._add_run(dir_id, first, count)
+        return range(first, first + count)
+
+    def path(self, file_id):
+        start = self.name_ends[file_id - 1] if file_id else 0
+        name = self.names[start:self.name_ends[file_id]].decode(self.encoding, self.errors)
+        return self.dirs[self.file_dir[file_id]] + name
+
+    def find(self, path):
+        """Returns the id of `path` if it is in the catalogue and alive, otherwise -1.
+
+        Only the basenames in the file's own folder are compared.
+        """
+        cut = path.rfind(os.sep) + 1
+        dir_id = self.dir_ids.get(path[:cut])
+        if dir_id is None:
+            return -1
+        name = path[cut:].encode(self.encoding, self.errors)
+        names, ends = self.names, self.name_ends
+        for run in self.by_dir.get(dir_id, ()):
+            for file_id in run:
+                start = ends[file_id - 1] if file_id else 0
+                if self.alive[file_id] and names[start:ends[file_id]] == name:
+                    return file_id
+        return -1
+
+    def remove(self, file_ids):
+        for file_id in file_ids:
+            self.alive[file_id] = 0
+
+    def mark_changed(self, file_ids):
+        """Forgets the size, mtime and duration of files that were replaced on disk."""
+        for file_id in file_ids:
+            self.sizes[file_id] = self.mtimes[file_id] = -1
+            self.durations[file_id] = 0.0
+
+    def dirs_below(self, folders):
+        """The ids of the interned folders that are in or below `folders`."""
+        prefixes = tuple(os.path.join(folder, '') for folder in folders)
+        return {dir_id for prefix, dir_id in self.dir_ids.items() if prefix.startswith(prefixes)}
+
+    def in_dirs(self, file_ids, dir_ids, inside=True):
+        """The ids from `file_ids` whose folder is one of `dir_ids`, or with `inside` false, is not."""
+        return array('I', compress(file_ids, self.dir_flags(file_ids, dir_ids, inside)))
+
+    def dir_flags(self, file_ids, dir_ids, inside=True):
+        """Like `in_dirs`, but returns a flag for each of `file_ids` instead."""
+        file_dir = self.file_dir
+        return bytes((file_dir[file_id] in dir_ids) == inside for file_id in file_ids)
+
+    def remove_dirs(self, folders):
+        """Removes every file in or below `folders`."""
+        dead = self.dirs_below(folders)
+        if dead:
+            self.remove(compress(range(len(self.file_dir)), map(dead.__contains__, self.file_dir)))
+
+    def alive_ids(self, file_ids):
+        """The ids from `file_ids` that have not been removed."""
+        return array('I', compress(file_ids, map(self.alive.__getitem__, file_ids)))
+
+class CatalogueView:
+    """A selection of catalogue files that reads like a list of paths.
+
+    Only the ids are stored, 4 bytes per file. Indexing, slicing and
+    iteration build the paths as they go, which is all ClipSelector and
+    LibraryFilter need.
+    """
+    def __init__(self, catalogue, ids=None):
+        self.catalogue = catalogue
+        self.ids = array('I') if ids is None else ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(map(self.catalogue.path, self.ids[i]))
+        return self.catalogue.path(self.ids[i])
+
+    def __iter__(self):
+        return map(self.catalogue.path, self.ids)
+
+class ClipSelector:
+    """Picks random library files, as catalogue ids, without repeating recent picks.
+
+    Draws index straight into the live CatalogueView, so nothing is copied and
+    files appended by a running scan are eligible right away. The last
+    `window` picks are remembered in a deque backed by a set, and a draw that
+    hits one of them is retried. The window is capped at half the library,
+    which keeps the expected number of retries below two.
+
+    Draws are uniform and O(1) by default. With a `weights_of(files, start,
+    stop)` function, which returns the weights of `files[start:stop]`, they
+    are weighted instead, via binary search over a cumulative weight array in
+    O(log N). The weights themselves are kept alongside, one per file.
+    Appended files extend both arrays in place, and files taken out with
+    `removed_at` or `kept` have their weights moved or dropped, after which
+    only the cumulative sums are redone, a C-level pass. Changed weights are
+    only folded in by a full rebuild once `weights_version()` has moved on by
+    more than 1% of the library.
+    """
+    MAX_ATTEMPTS = 64
+    MIN_REBUILD_CHANGES = 1000
+
+    def __init__(self, files, window=50, weights_of=None, weights_version=None):
+        self.files = files
+        self.window = window
+        self.history = deque()
+        self.recent = set()
+        self.set_weighting(weights_of, weights_version)
+
+    def set_files(self, files):
+        self.files = files
+        self.weights = array('d')
+        self.cumulative = array('d')
+
+    def set_weighting(self, weights_of, weights_version=None):
+        self.weights_of = weights_of
+        self.weights_version = weights_version or (lambda: 0)
+        self.built_version = self.weights_version()
+        self.weights = array('d')
+        self.cumulative = array('d')
+
+    def removed_at(self, i):
+        """Follows the removal of the file at index `i` by a swap-pop, which moved the last file to `i`."""
+        weights = self.weights
+        if len(weights) == len(self.files) + 1:
+            weights[i] = weights[-1]
+            weights.pop()
+        else:
+            del weights[i:]
+        del self.cumulative[i:]
+
+    def kept(self, flags):
+        """Follows the file list being narrowed down to the files whose entry in `flags` is true."""
+        self.weights = array('d', compress(self.weights, flags))
+        self.cumulative = array('d')
+
+    def _sync_weights(self):
+        n = len(self.files)
+        version = self.weights_version()
+        if version - self.built_version > max(self.MIN_REBUILD_CHANGES, n // 100) or len(self.weights) > n:
+            self.built_version = version
+            self.weights = array('d')
+            self.cumulative = array('d')
+        if len(self.weights) < n:
+            self.weights.extend(self.weights_of(self.files, len(self.weights), n))
+        if len(self.cumulative) < n:
+            total = self.cumulative[-1] if self.cumulative else 0.0
+            self.cumulative.extend(islice(accumulate(self.weights[len(self.cumulative):n], initial=total), 1, None))
+
+    def _draw_index(self, n):
+        if self.weights_of is None:
+            return random.randrange(n)
+        self._sync_weights()
+        total = self.cumulative[n - 1]
+        if total <= 0:
+            return random.randrange(n)
+        return min(bisect_right(self.cumulative, random.random() * total, 0, n), n - 1)
+
+    def pick(self):
+        """Returns the id of a random file, or None if there are none."""
+        n = len(self.files)
+        if n == 0:
+            return None
+        ids = self.files.ids
+        limit = min(self.window, n // 2)
+        for _ in range(self.MAX_ATTEMPTS):
+            file_id = ids[self._draw_index(n)]
+            if file_id not in self.recent:
+                break
+        self.history.append(file_id)
+        self.recent.add(file_id)
+        while len(self.history) > limit:
+            self.recent.discard(self.history.popleft())
+        return file_id
+
+def percentile(values, pct):
+    """The `pct`th percentile of `values` by linear interpolation, or None if there are none."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+class SwitchTiming:
+    """Times the phases of one clip switch, from the moment it was asked for to its first frame.
+
+    Each `mark(phase)` adds the time since the previous mark to that phase.
+    """
+    def __init__(self, trigger, started=None):
+        self.trigger = trigger
+        self.started = self.last = started if started is not None else time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + (now - self.last) * 1000
+        self.last = now
+
+    def total_ms(self):
+        return (self.last - self.started) * 1000
+
+class Metrics:
+    """Timings and playback health, appended as JSON lines to `metrics.jsonl` in the config directory.
+
+    Every record carries the event name, a wall-clock time and a per-run
+    session id, so files collected from several machines can be concatenated
+    and summarised with `summarize_metrics`. The most recent values of each
+    numeric field are also kept in memory for the stats overlay.
+    """
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, path, enabled=True, keep=500):
+        self.path = path
+        self.enabled = enabled
+        self.keep = keep
+        self.session = os.urandom(6).hex()
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, event, **fields):
+        with self.lock:
+            for name, value in fields.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.samples.setdefault((event, name), deque(maxlen=self.keep)).append(value)
+            if not self.enabled:
+                return
+            entry = {'event': event, 'time': round(time.time(), 3), 'session': self.session, **fields}
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+            except OSError as e:
+                print(f"Warning: Could not write metrics to {self.path}: {e}", file=sys.stderr)
+                self.enabled = False
+
+    def percentiles(self, event, name):
+        """Returns {pct: value} over the recent in-memory samples of `name` in `event` records."""
+        with self.lock:
+            values = list(self.samples.get((event, name), ()))
+        return {pct: percentile(values, pct) for pct in self.PERCENTILES}
+
+def summarize_metrics(paths):
+    """Reads one or more metrics files and returns percentiles of every numeric field, keyed by 'event.field'."""
+    samples = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                event = entry.get('event')
+                for name, value in entry.items():
+                    if name != 'time' and isinstance(value, (int, float)) and not isinstance(value, bool):
+                        samples.setdefault(f'{event}.{name}', []).append(value)
+    return {key: dict(count=len(values), **{f'p{pct}': percentile(values, pct) for pct in Metrics.PERCENTILES})
+            for key, values in sorted(samples.items())}
+
+class ClipLibrary:
+    """The player's view of the library: scanned files, active filters, selection and metadata.
+
+    `library_files` holds everything the last scan found, `video_files` the
+    subset that passes the keyword and exclusion filters and is not
+    quarantined. Both are CatalogueViews over one shared `catalogue`.
+
+    The library can span several roots (see `Settings.library_roots`). Each
+    root has its own index shard and is scanned on its own, so a slow share
+    never holds up the others. Selection draws from the union of all roots
+    that are online; the files of a root in `offline` stay in the catalogue
+    but out of `video_files` until it comes back.
+
+    With `verbose` false, the per-clip messages of `choose_clip_bounds` are
+    left out, as a reel of hundreds of clips has no use for them.
+    """
+    READ_AHEAD_EDGE = 1 << 20
+    READ_AHEAD_BACKOFF = 5.0
+    MIN_RESUME = 5.0
+
+    def __init__(self, settings, verbose=True):
+        self.settings = settings
+        self.verbose = verbose
+        os.makedirs(settings.config_dir, exist_ok=True)
+        self.roots = settings.library_roots()
+        self.indexes = {}
+        self.root_scans = {}
+        self.offline = set()
+        legacy_index = os.path.join(settings.config_dir, 'library-index.sqlite3')
+        if os.path.exists(legacy_index) and self.roots:
+            # Indexes from before multiple roots become the shard of the first root.
+            primary = index_shard_path(settings.config_dir, self.roots[0])
+            if not os.path.exists(primary):
+                os.replace(legacy_index, primary)
+        self.metadata = MetadataCache(os.path.join(settings.config_dir, 'metadata.sqlite3'))
+        self.keyframes = KeyframeIndex(os.path.join(settings.config_dir, 'keyframes.sqlite3'))
+        self.quarantine = Quarantine(os.path.join(settings.config_dir, 'quarantine.sqlite3'))
+        self.state_file = os.path.join(settings.config_dir, 'state.json')
+        self.catalogue = Catalogue()
+        self.library_files = CatalogueView(self.catalogue)
+        self.filter = LibraryFilter(settings.keyword_filters, settings.exclusion_folders)
+        self.video_files = CatalogueView(self.catalogue)
+        self.withheld = set()
+        self.selector = ClipSelector(self.video_files, settings.no_repeat_window)
+        if settings.weighted_sampling:
+            self.selector.set_weighting(self.clip_weights, lambda: self.metadata.version)
+
+    def index_for(self, root):
+        """The index shard of library root `root`."""
+        index = self.indexes.get(root)
+        if index is None:
+            index = self.indexes[root] = LibraryIndex(index_shard_path(self.settings.config_dir, root))
+        return index
+
+    @property
+    def last_scan(self):
+        """The figures of the last scan of each root, added up."""
+        scans = [self.root_scans[root] for root in self.roots if root in self.root_scans]
+        if not scans:
+            return {}
+        totals = {key: sum(scan[key] for scan in scans) for key in ('folders', 'relisted', 'removed_folders', 'files')}
+        return dict(totals, seconds=max(scan['seconds'] for scan in scans))
+
+    def scan_root(self, root, on_batch=None, cancel=None, on_changes=None):
+        """Brings the index shard of `root` up to date and returns its folders as packed blocks.
+
+        Returns None if the root is offline. Excluded folders are pruned
+        during the walk, but keyword filters are not applied; see
+        `LibraryFilter`. Safe to call from a worker thread, one per root.
+        Batches of blocks, with their cached durations added, are handed to
+        `on_batch` (see `add_blocks`) while the walk is still in progress,
+        and `on_changes` gets the paths added and removed since the last scan.
+        """
+        if not os.path.isdir(root):
+            print(f"Error: Library path '{root}' does not exist or is offline.", file=sys.stderr)
+            return None
+
+        print(f"Scanning for videos in: {root}")
+        start = time.perf_counter()
+        index = self.index_for(root)
+
+        def with_durations(blocks):
+            on_batch([block + (self.metadata.block_durations(*block),) for block in blocks])
+        blocks = index.rescan(root, self.settings.supported_extensions, list(self.settings.exclusion_folders),
+                              on_batch=with_durations if on_batch else None, cancel=cancel,
+                              workers=self.settings.scan_threads, on_changes=on_changes)
+        files = sum(names.count(b'\0') + 1 for _, names, _, _ in blocks)
+        self.root_scans[root] = dict(index.last_scan, seconds=round(time.perf_counter() - start, 3), files=files)
+        print(f"Found {files} video files in '{root}'.")
+        return blocks
+
+    def scan(self, on_batch=None, cancel=None, on_changes=None):
+        """Scans every root in turn and returns the blocks of all the folders found.
+
+        Roots that turn out to be offline are taken out of the selection;
+        their files as last indexed still go to `on_batch`, so that they are
+        back when the root is. The player scans roots concurrently with
+        `scan_root` instead.
+        """
+        blocks = []
+        for root in self.roots:
+            found = self.scan_root(root, on_batch, cancel, on_changes)
+            self.set_root_online(root, found is not None)
+            if found is None and on_batch:
+                on_batch(self.cached_blocks(root))
+            blocks.extend(found or ())
+        return blocks
+
+    def cached_blocks(self, root):
+        """The folders of `root` as its last scan left them, with cached durations, ready for `add_blocks`."""
+        return [block + (self.metadata.block_durations(*block),)
+                for block in self.index_for(root).cached_blocks(root, self.settings.supported_extensions)]
+
+    def restore(self):
+        """Fills the library from the index shards as the last scans left them, without walking the disk.
+
+        Returns False if the shards hold nothing for the current roots.
+        """
+        start = time.perf_counter()
+        self.reset()
+        for root in self.roots:
+            for block in self.cached_blocks(root):
+                self.catalogue.add_block(*block)
+        if not len(self.catalogue):
+            return False
+        self.library_files.ids = array('I', range(len(self.catalogue)))
+        self.video_files.ids = self._selectable(self.library_files.ids)
+        self.selector.set_files(self.video_files)
+        print(f"Restored {len(self.video_files)} videos from the library index "
+              f"in {(time.perf_counter() - start) * 1000:.0f} ms.")
+        return True
+
+    def is_online(self, root):
+        return root not in self.offline
+
+    def set_root_online(self, root, online):
+        """Takes the files of `root` out of the selection while it is offline, and puts them back when it returns.
+
+        Nothing is rescanned: the files stay in the catalogue in the
+        meantime. Returns True if the state of the root changed.
+        """
+        if online == self.is_online(root):
+            return False
+        dir_ids = self.catalogue.dirs_below([root])
+        if online:
+            self.offline.discard(root)
+            returning = self.catalogue.in_dirs(self.library_files.ids, dir_ids)
+            # Extended in place, so the selector only has to weigh the returning files.
+            self.video_files.ids.extend(self._selectable(returning))
+            print(f"Library folder '{root}' is back online with {len(returning)} files.")
+        else:
+            self.offline.add(root)
+            flags = self.catalogue.dir_flags(self.video_files.ids, dir_ids, inside=False)
+            self.video_files.ids = array('I', compress(self.video_files.ids, flags))
+            self.selector.kept(flags)
+            print(f"Library folder '{root}' is offline; its files are left out until it returns.",
+                  file=sys.stderr)
+        return True
+
+    def last_clip(self):
+        """The clip that was playing when the player was last closed, from its saved position on.
+
+        Returns None if there is none, or the file is nearly finished,
+        filtered out, quarantined or under an offline root. Whether the file
+        is still there is left to the caller, which can check that off the
+        GTK thread.
+        """
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            path, position, end_pos = state['path'], float(state['position']), float(state['end_pos'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if (end_pos - position < self.MIN_RESUME or not self.filter.apply([path])
+                or self.quarantine.is_active(path) or is_excluded(path, self.offline)):
+            return None
+        return Clip(path, position, end_pos)
+
+    def save_last_clip(self, clip, position=None):
+        """Remembers `clip` and the position in it, so that `last_clip` can resume it on the next start."""
+        state = {'path': clip.path, 'position': clip.start_pos if position is None else position,
+                 'end_pos': clip.end_pos}
+        try:
+            with open(self.state_file, 'w') as f:
+                json.dump(state, f)
+        except OSError as e:
+            print(f"Warning: Could not save the last clip to {self.state_file}: {e}", file=sys.stderr)
+
+    def reset(self):
+        """Empties the file lists ahead of a new scan and picks up the current roots and filter settings."""
+        self.filter = LibraryFilter(self.settings.keyword_filters, self.settings.exclusion_folders)
+        self.roots = self.settings.library_roots()
+        self.offline = set()
+        self.catalogue = Catalogue()
+        self.library_files = CatalogueView(self.catalogue)
+        self.video_files = CatalogueView(self.catalogue)
+        self.withheld = set()
+        self.selector.set_files(self.video_files)
+        # Ids start over in the new catalogue, so the recent picks no longer name the same files.
+        self.selector.history.clear()
+        self.selector.recent.clear()
+
+    def _selectable(self, file_ids):
+        """The ids that pass the filters and are not quarantined; quarantined paths are noted in `withheld`."""
+        catalogue = self.catalogue
+        file_ids = self.filter.select(catalogue, file_ids)
+        held = {}
+        for path in list(self.quarantine.entries):
+            if self.quarantine.is_active(path):
+                file_id = catalogue.find(path)
+                if file_id >= 0:
+                    held[file_id] = path
+        if held:
+            # One pass over the ids, however many files are quarantined.
+            kept = array('I', filterfalse(held.__contains__, file_ids))
+            if len(kept) == len(file_ids):
+                return file_ids
+            if len(file_ids) - len(kept) < len(held):
+                held = {file_id: held[file_id] for file_id in compress(file_ids, map(held.__contains__, file_ids))}
+            self.withheld.update(held.values())
+            file_ids = kept
+        return file_ids
+
+    def add_blocks(self, blocks):
+        """Adds scanned folders, as `scan_root` hands them to `on_batch`, to the library.
+
+        Files of offline roots are added but left out of the selection.
+        """
+        file_ids = array('I')
+        for block in blocks:
+            file_ids.extend(self.catalogue.add_block(*block))
+        self.library_files.ids.extend(file_ids)
+        if self.offline:
+            file_ids = self.catalogue.in_dirs(file_ids, self.catalogue.dirs_below(self.offline), inside=False)
+        # Extended in place, so the selector sees the new files without a reset.
+        self.video_files.ids.extend(self._selectable(file_ids))
+
+    def add_files(self, paths):
+        """Adds newly discovered paths and returns the ones that pass the filters and need probing.
+
+        A path that is already in the library is not added again: the file
+        was replaced on disk, so only its size, mtime and duration are
+        forgotten, and it is returned to be probed afresh.
+        """
+        catalogue = self.catalogue
+        paths = list(paths)
+        known = list(map(catalogue.find, paths))
+        replaced = [file_id for file_id in known if file_id >= 0]
+        if replaced:
+            catalogue.mark_changed(replaced)
+            paths = list(compress(paths, map((-1).__eq__, known)))
+        file_ids = catalogue.add_paths(paths)
+        self.library_files.ids.extend(file_ids)
+        selectable = self._selectable(file_ids)
+        # Extended in place, so the selector sees the new files without a reset.
+        self.video_files.ids.extend(selectable)
+        if len(selectable) < len(paths):
+            paths = list(map(catalogue.path, selectable))
+        return paths + self.filter.apply(map(catalogue.path, replaced))
+
+    def remove_files(self, removed, removed_dirs=()):
+        """Drops deleted files and everything below deleted folders.
+
+        Returns a predicate telling whether a given path is still in the library.
+        """
+        catalogue = self.catalogue
+        catalogue.remove([file_id for file_id in map(catalogue.find, removed) if file_id >= 0])
+        if removed_dirs:
+            catalogue.remove_dirs(removed_dirs)
+        self.library_files.ids = catalogue.alive_ids(self.library_files.ids)
+        flags = bytes(map(catalogue.alive.__getitem__, self.video_files.ids))
+        self.video_files.ids = array('I', compress(self.video_files.ids, flags))
+        self.selector.kept(flags)
+        self.withheld = {path for path in self.withheld if catalogue.find(path) >= 0}
+        return lambda path: catalogue.find(path) >= 0
+
+    def apply_filters(self):
+        """Re-filters the in-memory library with the current settings, without touching the disk."""
+        start = time.perf_counter()
+        self.filter = LibraryFilter(self.settings.keyword_filters, self.settings.exclusion_folders)
+        self.withheld = set()
+        file_ids = self.library_files.ids
+        if self.offline:
+            file_ids = self.catalogue.in_dirs(file_ids, self.catalogue.dirs_below(self.offline), inside=False)
+        self.video_files.ids = self._selectable(file_ids)
+        self.selector.set_files(self.video_files)
+        print(f"Filtered library to {len(self.video_files)} of {len(self.library_files)} files "
+              f"in {(time.perf_counter() - start) * 1000:.0f} ms.")
+
+    def quarantine_file(self, path, reason, mtime_ns=-1):
+        """Quarantines `path` and takes it out of the selection."""
+        self.quarantine.add(path, reason, mtime_ns)
+        self.sync_quarantine(path)
+
+    def sync_quarantine(self, path):
+        """Takes `path` out of the selection while it is quarantined, and puts it back once released.
+
+        Taking a file out is O(N) in the library size, but only happens when it fails.
+        """
+        if self.quarantine.is_active(path):
+            if path in self.withheld:
+                return
+            ids = self.video_files.ids
+            try:
+                i = ids.index(self.catalogue.find(path))
+            except ValueError:
+                return
+            self.withheld.add(path)
+            ids[i] = ids[-1]
+            ids.pop()
+            self.selector.removed_at(i)
+        elif path in self.withheld:
+            self.withheld.discard(path)
+            file_id = self.catalogue.find(path)
+            if file_id >= 0 and self.filter.apply([path]) and not is_excluded(path, self.offline):
+                self.video_files.ids.append(file_id)
+
+    def clip_weights(self, files, start, stop):
+        """Sampling weights for duration-weighted mode: the lengths in seconds of a CatalogueView's files."""
+        mean = self.metadata.mean_duration()
+        return [duration or mean for duration in map(self.catalogue.durations.__getitem__, files.ids[start:stop])]
+
+    def note_probed(self, path, info, file_id=-1):
+        """Takes the size, mtime and duration the prober read for `path` into the catalogue.
+
+        `file_id` is the id the prober was given for `path`. It is only
+        looked up again if it is missing or from a catalogue since reset.
+        """
+        catalogue = self.catalogue
+        if not (0 <= file_id < len(catalogue) and catalogue.alive[file_id] and catalogue.path(file_id) == path):
+            file_id = catalogue.find(path)
+        if file_id >= 0 and info is not None:
+            catalogue.sizes[file_id], catalogue.mtimes[file_id] = info.size, info.mtime_ns
+            catalogue.durations[file_id] = info.duration or 0.0
+
+    def root_files(self, root):
+        """The selectable files in or below `root`, as a CatalogueView."""
+        catalogue = self.catalogue
+        return CatalogueView(catalogue, catalogue.in_dirs(self.video_files.ids, catalogue.dirs_below([root])))
+
+    def unprobed(self, files=None):
+        """The selectable files whose duration is not known, as a backlog for the prober.
+
+        Given a CatalogueView of them in `files`, only those files are looked at.
+        """
+        ids = (self.video_files if files is None else files).ids
+        durations = self.catalogue.durations
+        return CatalogueView(self.catalogue, array('I', [file_id for file_id in ids if not durations[file_id]]))
+
+    def choose_clip_bounds(self, duration, keyframes=None):
+        """Returns a random (start_pos, end_pos, on_keyframe) for a file of the given duration.
+
+        If sorted keyframe times are given, the start is snapped to one of
+        them when any fall inside the allowed range; the clip's length is
+        chosen before snapping, so it stays within the configured limits.
+        """
+        min_clip_duration = self.settings.min_clip_duration
+        if duration is None or duration <= min_clip_duration:
+            if self.verbose:
+                print("Video is short, playing entire file.")
+            return 0, (duration + 1 if duration else 99999), False
+
+        actual_max_clip = min(self.settings.max_clip_duration, duration)
+        clip_duration = random.uniform(min_clip_duration, actual_max_clip)
+
+        min_start_boundary = duration * 0.10
+        max_start_boundary = (duration * 0.90) - clip_duration
+
+        if min_start_boundary < max_start_boundary:
+            if self.verbose:
+                print("Choosing clip from the middle 80% of the video.")
+        else:
+            min_start_boundary, max_start_boundary = 0, duration - clip_duration
+            if self.verbose:
+                print("Warning: Clip too long for 'safe zone'. Choosing from entire video.")
+
+        if keyframes:
+            first = bisect_left(keyframes, min_start_boundary)
+            last = bisect_right(keyframes, max_start_boundary)
+            if first < last:
+                # Rounded up so that mpv's backward seek lands on this keyframe rather than the one before.
+                start_pos = math.ceil(keyframes[random.randrange(first, last)] * 1000) / 1000
+                return start_pos, start_pos + clip_duration, True
+
+        start_pos = random.uniform(min_start_boundary, max_start_boundary)
+        return start_pos, start_pos + clip_duration, False
+
+    def plan_clip(self, file_id):
+        """Returns a Clip for catalogue file `file_id` from its cached duration, or None if it has not been probed.
+
+        The catalogue only holds durations that were read from the file at
+        its current size and mtime, and a file that changes on disk has its
+        duration forgotten (see `add_files`), so a stale one counts as none.
+        """
+        duration = self.catalogue.durations[file_id] if self.catalogue.alive[file_id] else 0.0
+        if not duration:
+            return None
+        path = self.catalogue.path(file_id)
+        keyframes = None
+        if self.settings.snap_to_keyframes:
+            indexed = self.keyframes.get(path)
+            if indexed is not None:
+                keyframes = indexed[0]
+        return Clip(path, *self.choose_clip_bounds(duration, keyframes), file_id)
+
+    def read_ahead_ranges(self, clip, budget):
+        """Estimates the byte ranges mpv reads first when it starts `clip`, up to `budget` bytes.
+
+        That is the container header and index at either end of the file,
+        then the clip itself from the keyframe before its start. Without a
+        keyframe index the offsets are estimated from the average bitrate.
+        """
+        file_id = clip.file_id if clip.file_id >= 0 else self.catalogue.find(clip.path)
+        if file_id < 0 or budget <= 0:
+            return []
+        size, duration = self.catalogue.sizes[file_id], self.catalogue.durations[file_id]
+        if size <= 0 or not duration:
+            return []
+        edge = min(self.READ_AHEAD_EDGE, budget // 8, size // 2)
+        ranges = [(0, edge), (size - edge, edge)] if edge else []
+        budget -= 2 * edge
+        byte_rate = size / duration
+        start = None
+        indexed = self.keyframes.get(clip.path)
+        if indexed is not None:
+            times, positions = indexed
+            i = bisect_right(times, clip.start_pos + 0.001) - 1
+            if i >= 0 and positions[i] >= 0:
+                start = positions[i]
+        if start is None:
+            # mpv seeks back to the keyframe before the start, usually no more than a few seconds.
+            start = int(max(0.0, clip.start_pos - self.READ_AHEAD_BACKOFF) * byte_rate)
+        length = int((clip.end_pos - clip.start_pos + self.READ_AHEAD_BACKOFF) * byte_rate)
+        length = min(length, budget, size - start)
+        if length > 0:
+            ranges.append((start, length))
+        return ranges
+
+    def pick_clip(self, timing=None):
+        """Picks a file and plans its clip from the cached duration; the selection half of a clip switch.
+
+        Returns (path, clip), where clip is None if the file has not been probed yet.
+        """
+        file_id = self.selector.pick()
+        path, clip = self.catalogue.path(file_id), self.plan_clip(file_id)
+        if timing is not None:
+            timing.mark('selection')
+        return path, clip
+
+    def start_clip(self, player, path, clip=None, timing=None, on_load=None):
+        """Starts `path` in `player` and returns its Clip; the mpv half of a clip switch.
+
+        mpv enforces the clip's end through the per-file `end` option.
+        Without a planned `clip`, this waits for mpv to open the file and
+        chooses one from its duration. Returns None if the file does not
+        open within `open_timeout` seconds; the caller should quarantine it.
+        `on_load` is called with the path straight after the loadfile.
+        Only the player is touched, so this can run on a player-control thread.
+        """
+        mark = timing.mark if timing is not None else lambda phase: None
+        if clip is not None:
+            # Known duration: let mpv open the file at the start position.
+            player.loadfile(path, 'replace', **clip_options(clip))
+            if on_load:
+                on_load(path)
+            mark('loadfile')
+            return clip
+        player.loadfile(path, 'replace')
+        if on_load:
+            on_load(path)
+        mark('loadfile')
+        try:
+            player.wait_for_property('duration', timeout=self.settings.open_timeout)
+        except (TimeoutError, FutureTimeoutError):
+            player.command('stop')
+            mark('duration_wait')
+            return None
+        mark('duration_wait')
+        clip = Clip(path, *self.choose_clip_bounds(player.duration))
+        player.file_local['end'] = f'{clip.end_pos:.3f}'
+        player.seek(clip.start_pos, 'absolute')
+        mark('seek')
+        return clip
+
+    def load_random_clip(self, player, on_uncached=None, timing=None):
+        """Picks a file, starts it in `player` and returns its Clip.
+
+        If the file has no cached duration, `on_uncached` is called with the
+        path so it can be probed for next time. A file that mpv cannot open
+        within `open_timeout` seconds is quarantined and None is returned.
+        Phases are marked on `timing`, a SwitchTiming, if one is given.
+        """
+        path, clip = self.pick_clip(timing)
+        if clip is None and on_uncached:
+            on_uncached(path)
+        started = self.start_clip(player, path, clip, timing)
+        if started is None:
+            self.quarantine_file(path, f"not opened within {self.settings.open_timeout}s")
+        return started
+
+def edl_segment(clip):
+    """One mpv EDL segment for `clip`. The path is length-prefixed, so commas and the like need no escaping."""
+    return (f"%{len(clip.path.encode('utf-8', 'surrogateescape'))}%{clip.path},"
+            f"start={clip.start_pos:.3f},length={clip.end_pos - clip.start_pos:.3f}")
+
+def write_reel(clips, f, fmt='m3u'):
+    """Writes `clips` as a single mpv EDL file ('edl') or as a playlist of one-segment edl:// entries ('m3u').
+
+    mpv opens every file of an EDL up front, so an EDL suits short reels;
+    a playlist only opens each file as its turn comes up.
+    """
+    if fmt == 'edl':
+        f.write("# mpv EDL v0\n")
+        for clip in clips:
+            f.write(edl_segment(clip) + "\n")
+    else:
+        f.write("#EXTM3U\n")
+        for clip in clips:
+            f.write(f"edl://{edl_segment(clip)}\n")
+
+def build_reel(library, count):
+    """Plans `count` random clips from the files in `library` whose duration is known.
+
+    Clips follow the same rules as interactive playback, including the
+    no-repeat window and, if enabled, weighting and keyframe snapping.
+    """
+    videos = library.video_files
+    catalogue = videos.catalogue
+
+    def playable_file(file_id):
+        # A newline cannot be written into a playlist line.
+        return bool(catalogue.durations[file_id]) and '\n' not in catalogue.path(file_id)
+    playable = CatalogueView(catalogue, array('I', filter(playable_file, videos.ids)))
+    if len(playable) < len(videos):
+        print(f"{len(videos) - len(playable)} of {len(videos)} videos have not "
+              f"been probed yet and are left out.", file=sys.stderr)
+    library.video_files = playable
+    library.selector.set_files(playable)
+    if not playable:
+        return []
+    return [library.plan_clip(library.selector.pick()) for _ in range(count)]
+
+def reel_main(argv):
+    """`serendipity-player.py reel`: writes a reel of random clips for mpv without starting the GUI."""
+    parser = argparse.ArgumentParser(
+        prog='serendipity-player.py reel',
+        description="Write N random clips from the library as an mpv EDL or playlist.")
+    parser.add_argument('-n', '--clips', type=int, default=100, help="number of clips (default: 100)")
+    parser.add_argument('-o', '--output', default='-', help="file to write, or - for stdout (default)")
+    parser.add_argument('-f', '--format', choices=('m3u', 'edl'),
+                        help="m3u: a playlist of edl:// entries, opened one at a time; edl: a single EDL. "
+                             "Defaults to edl for .edl output files and m3u otherwise.")
+    parser.add_argument('--scan', action='store_true',
+                        help="bring the library index up to date first instead of using it as cached")
+    parser.add_argument('--seed', type=int, help="random seed, for reproducible reels")
+    parser.add_argument('--config-dir', default=default_config_dir(),
+                        help="settings and caches to use (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    if args.seed is not None:
+        random.seed(args.seed)
+    fmt = args.format or ('edl' if args.output.endswith('.edl') else 'm3u')
+    settings = Settings(args.config_dir).load()
+    library = ClipLibrary(settings, verbose=False)
+    with redirect_stdout(sys.stderr):
+        if args.scan or not library.restore():
+            library.reset()
+            library.scan(on_batch=library.add_blocks)
+    clips = build_reel(library, args.clips)
+    if not clips:
+        print("Error: No probed videos in the library. Run the player for a while first, so that "
+              "durations get cached.", file=sys.stderr)
+        return 1
+    if args.output == '-':
+        write_reel(clips, sys.stdout, fmt)
+    else:
+        with open(args.output, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            write_reel(clips, f, fmt)
+    total = sum(clip.end_pos - clip.start_pos for clip in clips)
+    print(f"Wrote {len(clips)} clips ({total / 60:.0f} min) from {len(library.video_files)} videos "
+          f"in {time.perf_counter() - start:.2f}s.", file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    # Summarises metrics files, e.g. ones collected from several machines:
+    #   python serendipity_core.py metrics-a.jsonl metrics-b.jsonl
+    paths = sys.argv[1:] or [os.path.join(default_config_dir(), 'metrics.jsonl')]
+    print(json.dumps(summarize_metrics(paths), indent=4))
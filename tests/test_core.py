@@ -0,0 +1,308 @@
+"""Behaviour tests for the headless core, run with `python -m pytest tests`."""
+import os
+import sys
+import random
+import sqlite3
+import subprocess
+from array import array
+from itertools import accumulate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import pytest
+
+from serendipity_core import (Catalogue, CatalogueView, Clip, ClipLibrary, ClipSelector, KeyframeIndex,
+                              KeyframeIndexer, LibraryFilter, LibraryIndex, MediaInfo, Settings, WorkQueue,
+                              build_reel)
+from bench_library import FakePlayer
+
+EXTENSIONS = ('.mkv', '.mp4')
+
+def touch(path, data=b''):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def block_paths(blocks):
+    return sorted(os.path.join(directory, name) for directory, names, _, _ in blocks
+                  for name in os.fsdecode(names).split('\0'))
+
+def make_library(tmp_path, paths):
+    root = str(tmp_path / 'library')
+    for path in paths:
+        touch(os.path.join(root, path))
+    config_dir = tmp_path / 'config'
+    config_dir.mkdir()
+    settings = Settings(str(config_dir))
+    settings.video_library_path = root
+    library = ClipLibrary(settings)
+    library.scan(on_batch=library.add_blocks)
+    return library, root
+
+# LibraryIndex.rescan
+
+def test_rescan_finds_videos_and_skips_other_files(tmp_path):
+    root = str(tmp_path)
+    for name in ('a/one.mkv', 'a/b/two.MP4', 'a/poster.jpg', 'three.mkv'):
+        touch(os.path.join(root, name))
+    batches = []
+    blocks = LibraryIndex(str(tmp_path / 'index.sqlite3')).rescan(root, EXTENSIONS, on_batch=batches.append)
+    expected = sorted(os.path.join(root, name) for name in ('a/one.mkv', 'a/b/two.MP4', 'three.mkv'))
+    assert block_paths(blocks) == expected
+    assert block_paths([block for batch in batches for block in batch]) == expected
+
+def test_rescan_prunes_exclusions(tmp_path):
+    root = str(tmp_path / 'lib')
+    touch(os.path.join(root, 'keep/one.mkv'))
+    touch(os.path.join(root, 'skip/two.mkv'))
+    blocks = LibraryIndex(str(tmp_path / 'index.sqlite3')).rescan(root, EXTENSIONS, [os.path.join(root, 'skip')])
+    assert block_paths(blocks) == [os.path.join(root, 'keep/one.mkv')]
+
+def test_rescan_relists_only_changed_folders_and_reports_changes(tmp_path):
+    root = str(tmp_path / 'lib')
+    for name in ('a/one.mkv', 'a/two.mkv', 'b/three.mkv'):
+        touch(os.path.join(root, name))
+    index = LibraryIndex(str(tmp_path / 'index.sqlite3'))
+    index.rescan(root, EXTENSIONS)
+
+    os.remove(os.path.join(root, 'a/two.mkv'))
+    touch(os.path.join(root, 'a/four.mkv'))
+    # Replaced by a different file, as a finished download would be.
+    touch(os.path.join(root, 'a/one.tmp'), b'new contents')
+    os.replace(os.path.join(root, 'a/one.tmp'), os.path.join(root, 'a/one.mkv'))
+    changes = []
+    blocks = index.rescan(root, EXTENSIONS, on_changes=lambda added, removed: changes.append((added, removed)))
+
+    assert index.last_scan['relisted'] == 1
+    expected = sorted(os.path.join(root, name) for name in ('a/one.mkv', 'a/four.mkv', 'b/three.mkv'))
+    assert block_paths(blocks) == expected
+    [(added, removed)] = changes
+    assert sorted(added) == [os.path.join(root, 'a/four.mkv'), os.path.join(root, 'a/one.mkv')]
+    assert removed == [os.path.join(root, 'a/two.mkv')]
+
+def test_rescan_reports_removed_folders(tmp_path):
+    root = str(tmp_path / 'lib')
+    touch(os.path.join(root, 'a/one.mkv'))
+    touch(os.path.join(root, 'b/two.mkv'))
+    index = LibraryIndex(str(tmp_path / 'index.sqlite3'))
+    index.rescan(root, EXTENSIONS)
+    os.remove(os.path.join(root, 'b/two.mkv'))
+    os.rmdir(os.path.join(root, 'b'))
+    changes = []
+    index.rescan(root, EXTENSIONS, on_changes=lambda added, removed: changes.append((added, removed)))
+    assert changes == [([], [os.path.join(root, 'b/two.mkv')])]
+
+# LibraryFilter.select against LibraryFilter.apply
+
+@pytest.fixture(scope='module')
+def random_catalogue():
+    # Short names from a small alphabet, so that keywords often run across two basenames in the buffer.
+    rng = random.Random(3)
+    paths = []
+    for _ in range(300):
+        folder = '/m/' + ''.join(rng.choice('abS0é ') for _ in range(rng.randint(1, 6)))
+        for _ in range(rng.randint(0, 8)):
+            paths.append(folder + '/' + ''.join(rng.choice('abS01éE.') for _ in range(rng.randint(1, 7))))
+    paths.sort(key=lambda path: path.rpartition('/')[0])
+    catalogue = Catalogue()
+    catalogue.add_paths(paths[:700])
+    catalogue.add_paths(paths[700:])
+    return catalogue, paths
+
+@pytest.mark.parametrize('keywords', ['', 's0', 'b, a1', 'S01', 'é', 'ab, 0a', 'x', '1s'])
+@pytest.mark.parametrize('exclusions', [[], ['/m/a', '/m/S0']])
+def test_select_matches_apply(random_catalogue, keywords, exclusions):
+    catalogue, paths = random_catalogue
+    expected = sorted(LibraryFilter(keywords, exclusions).apply(paths))
+    selected = LibraryFilter(keywords, exclusions).select(catalogue, array('I', range(len(catalogue))))
+    assert sorted(map(catalogue.path, selected)) == expected
+
+@pytest.mark.parametrize('keywords', ['s0', 'é'])
+def test_select_follows_a_growing_catalogue(random_catalogue, keywords):
+    _, paths = random_catalogue
+    catalogue = Catalogue()
+    library_filter = LibraryFilter(keywords, ['/m/a'])
+    selected = array('I')
+    for start in range(0, len(paths), 37):
+        selected.extend(library_filter.select(catalogue, catalogue.add_paths(paths[start:start + 37])))
+    assert sorted(map(catalogue.path, selected)) == sorted(LibraryFilter(keywords, ['/m/a']).apply(paths))
+
+# ClipSelector
+
+def make_view(count):
+    catalogue = Catalogue()
+    catalogue.add_paths([f'/m/{i // 10}/{i}.mkv' for i in range(count)])
+    return CatalogueView(catalogue, array('I', range(count)))
+
+def test_selector_does_not_repeat_within_its_window():
+    view = make_view(40)
+    selector = ClipSelector(view, window=10)
+    picks = [selector.pick() for _ in range(500)]
+    for i in range(len(picks) - 10):
+        assert len(set(picks[i:i + 11])) == 11
+
+def test_selector_window_is_capped_at_half_the_library():
+    selector = ClipSelector(make_view(2), window=50)
+    assert {selector.pick() for _ in range(20)} == {0, 1}
+
+def test_selector_picks_nothing_from_an_empty_library():
+    assert ClipSelector(make_view(0)).pick() is None
+
+def weights_from(weights):
+    return lambda files, start, stop: [weights[file_id] for file_id in files.ids[start:stop]]
+
+def test_weighted_selector_never_picks_weightless_files():
+    view = make_view(50)
+    weights = [float(file_id % 2) for file_id in range(50)]
+    selector = ClipSelector(view, window=0, weights_of=weights_from(weights))
+    picked = {selector.pick() for _ in range(500)}
+    assert picked and all(file_id % 2 for file_id in picked)
+
+def test_weighted_selector_keeps_weights_in_step_with_the_files():
+    rng = random.Random(5)
+    view = make_view(300)
+    weights = [rng.uniform(1, 100) for _ in range(300)]
+    weights_of = weights_from(weights)
+    selector = ClipSelector(view, window=5, weights_of=weights_of)
+
+    def check():
+        selector.pick()
+        expected = array('d', weights_of(view, 0, len(view)))
+        assert selector.weights == expected
+        assert selector.cumulative == pytest.approx(list(accumulate(expected)))
+
+    check()
+    for step in range(100):
+        ids = view.ids
+        if step % 3 == 0:
+            # Swap-pop, as sync_quarantine takes a file out.
+            i = rng.randrange(len(ids))
+            ids[i] = ids[-1]
+            ids.pop()
+            selector.removed_at(i)
+        elif step % 3 == 1:
+            flags = bytes(rng.random() < 0.95 for _ in ids)
+            view.ids = array('I', [file_id for file_id, keep in zip(ids, flags) if keep])
+            selector.kept(flags)
+        else:
+            ids.extend(rng.sample(range(300), 5))
+        if step % 2:
+            check()
+    check()
+
+# WorkQueue
+
+class IdleQueue(WorkQueue):
+    def _worker(self):
+        pass
+
+def test_backlog_extended_from_a_new_catalogue_drops_the_old_ids():
+    queue = IdleQueue()
+    queue.set_backlog(make_view(30))
+    queue.extend_backlog(['/elsewhere/a.mkv'])
+    new = make_view(2)
+    queue.extend_backlog(new)
+    entries = {queue._next_entry() for _ in range(3)}
+    assert entries == {('/m/0/0.mkv', 0), ('/m/0/1.mkv', 1), ('/elsewhere/a.mkv', -1)}
+    assert queue.catalogue is new.catalogue and not queue.backlog_ids
+
+# KeyframeIndexer
+
+def test_keyframe_times_are_relative_to_the_start_time(tmp_path, monkeypatch):
+    output = b'packet,1.400000,48,K__\npacket,1.440000,900,___\npacket,3.400000,5000,K__\nformat,1.400000\n'
+    monkeypatch.setattr(subprocess, 'run', lambda args, **kwargs: subprocess.CompletedProcess(args, 0, output))
+    indexer = KeyframeIndexer(KeyframeIndex(str(tmp_path / 'keyframes.sqlite3')))
+    times, positions = indexer._read_keyframes('/m/a.mkv')
+    indexer.stop()
+    assert list(times) == pytest.approx([0.0, 2.0]) and list(positions) == [48, 5000]
+
+def test_keyframe_index_drops_absolute_times_of_older_versions(tmp_path):
+    db_path = str(tmp_path / 'keyframes.sqlite3')
+    with sqlite3.connect(db_path) as conn:
+        conn.executescript(KeyframeIndex.SCHEMA + "PRAGMA user_version = 0;")
+        conn.execute("INSERT INTO keyframes VALUES (?, 1, 1, ?, ?)", (b'/m/a.mkv', b'', b''))
+    conn.close()
+    assert KeyframeIndex(db_path).get('/m/a.mkv') is None
+
+# ClipLibrary.start_clip against a fake player
+
+@pytest.fixture
+def library(tmp_path):
+    library, _ = make_library(tmp_path, ['show/one.mkv', 'show/two.mkv'])
+    return library
+
+def test_plan_clip_needs_a_duration(library):
+    file_id = library.catalogue.find(library.library_files[0])
+    assert library.plan_clip(file_id) is None
+    library.note_probed(library.library_files[0], MediaInfo(0, 0, 600.0, 'mkv', '[]'), file_id)
+    clip = library.plan_clip(file_id)
+    assert clip.path == library.library_files[0] and clip.file_id == file_id
+
+def test_note_probed_looks_up_a_stale_id(library):
+    path = library.library_files[1]
+    library.note_probed(path, MediaInfo(0, 0, 600.0, 'mkv', '[]'), 0)
+    assert list(library.catalogue.durations) == [0.0, 600.0]
+
+def test_unprobed_files_of_one_root(tmp_path):
+    library, root = make_library(tmp_path, ['a/one.mkv', 'a/two.mkv', 'b/three.mkv'])
+    library.catalogue.durations[library.catalogue.find(os.path.join(root, 'a/one.mkv'))] = 60.0
+    assert list(library.unprobed(library.root_files(os.path.join(root, 'a')))) == [os.path.join(root, 'a/two.mkv')]
+    assert len(library.unprobed()) == 2
+
+def test_last_clip_skips_quarantined_and_offline_files(tmp_path):
+    library, root = make_library(tmp_path, ['show/one.mkv'])
+    path = library.library_files[0]
+    library.save_last_clip(Clip(path, 10.0, 100.0), position=20.0)
+    assert library.last_clip() == Clip(path, 20.0, 100.0)
+    library.set_root_online(root, False)
+    assert library.last_clip() is None
+    library.set_root_online(root, True)
+    library.quarantine_file(path, 'test')
+    assert library.last_clip() is None
+
+def test_start_clip_with_a_planned_clip_passes_its_bounds_to_loadfile(library):
+    path = library.library_files[0]
+    library.catalogue.durations[0] = 600.0
+    clip = library.plan_clip(0)
+    player = FakePlayer()
+    loaded = []
+    assert library.start_clip(player, path, clip, on_load=loaded.append) == clip
+    assert player.path == path and loaded == [path]
+    assert player.options == {'start': f'{clip.start_pos:.3f}', 'end': f'{clip.end_pos:.3f}'}
+    assert 0 <= clip.start_pos < clip.end_pos <= 600.0
+
+def test_start_clip_without_a_duration_waits_then_bounds_the_file(library):
+    path = library.library_files[0]
+    player = FakePlayer(duration=1200.0)
+    clip = library.start_clip(player, path)
+    assert clip.path == path and 0 <= clip.start_pos < clip.end_pos <= 1200.0
+    assert player.file_local['end'] == f'{clip.end_pos:.3f}'
+    assert player.time_pos == clip.start_pos
+
+def test_start_clip_gives_up_on_a_file_that_does_not_open(library):
+    player = FakePlayer(duration=None)
+    assert library.start_clip(player, library.library_files[0]) is None
+    assert player.commands == [('stop',)]
+
+def test_load_random_clip_quarantines_a_file_that_does_not_open(library):
+    library.settings.open_timeout = 0
+    assert library.load_random_clip(FakePlayer(duration=None)) is None
+    assert len(library.quarantine.entries) == 1 and len(library.video_files) == 1
+
+def test_fake_player_rejects_what_mpv_rejects():
+    player = FakePlayer()
+    with pytest.raises(AttributeError):
+        player['file-local-options/end'] = '10'
+    with pytest.raises(AttributeError):
+        player['frame-drop-count']
+
+def test_build_reel_plans_clips_without_per_clip_messages(tmp_path, capsys):
+    library, _ = make_library(tmp_path, ['show/one.mkv', 'show/two.mkv', 'show/three.mkv'])
+    library.verbose = False
+    library.catalogue.durations[0] = library.catalogue.durations[2] = 600.0
+    capsys.readouterr()
+    clips = build_reel(library, 4)
+    assert len(clips) == 4 and {clip.file_id for clip in clips} == {0, 2}
+    assert capsys.readouterr().out == ''